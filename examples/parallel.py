@@ -1,11 +1,10 @@
 from multiprocessing import Pool
 from argparse import ArgumentParser
 from tbselenium.tbdriver import TorBrowserDriver
-from tbselenium.utils import launch_tbb_tor_with_stem
-from tbselenium.common import STEM_SOCKS_PORT, USE_RUNNING_TOR,\
-    STEM_CONTROL_PORT
+from tbselenium.fleet import TorFleet
 
 JOBS_IN_PARALLEL = 3
+TOR_PROCESSES = 3
 
 
 def run_in_parallel(inputs, worker, no_of_processes=JOBS_IN_PARALLEL):
@@ -13,22 +12,23 @@ def run_in_parallel(inputs, worker, no_of_processes=JOBS_IN_PARALLEL):
     p.map(worker, inputs)
 
 
-def visit_check_tpo_with_stem(tbb_dir):
+def visit_check_tpo_with_stem(job):
+    tbb_dir, driver_kwargs = job
     url = "https://check.torproject.org"
-    with TorBrowserDriver(tbb_dir,
-                          socks_port=STEM_SOCKS_PORT,
-                          control_port=STEM_CONTROL_PORT,
-                          tor_cfg=USE_RUNNING_TOR) as driver:
+    with TorBrowserDriver(tbb_dir, **driver_kwargs) as driver:
         driver.load_url(url, wait_on_page=3)
         print(driver.find_element_by("h1.on").text)
         print(driver.find_element_by(".content > p").text)
 
 
 def launch_browsers_in_parallel(tbb_path):
-    tor_process = launch_tbb_tor_with_stem(tbb_path=tbb_path)
-    run_in_parallel(JOBS_IN_PARALLEL * [tbb_path],
-                    visit_check_tpo_with_stem)
-    tor_process.kill()
+    # launch several tor processes so that browsers don't share a single one
+    with TorFleet(tbb_path, size=TOR_PROCESSES) as fleet:
+        jobs = []
+        for i in range(JOBS_IN_PARALLEL):
+            tor = fleet.instances[i % len(fleet.instances)]
+            jobs.append((tbb_path, tor.driver_kwargs))
+        run_in_parallel(jobs, visit_check_tpo_with_stem)
 
 
 def main():
@@ -4,7 +4,7 @@ from stem import CircStatus
 from tbselenium.tbdriver import TorBrowserDriver
 import tbselenium.common as cm
 from tbselenium.utils import launch_tbb_tor_with_stem
-from selenium.webdriver.common.utils import free_port
+from tbselenium.ports import lease_port
 import tempfile
 from os.path import join
 
@@ -30,8 +30,9 @@ def print_tor_circuits(controller):
 
 
 def launch_tb_with_custom_stem(tbb_dir):
-    socks_port = free_port()
-    control_port = free_port()
+    # leased ports are not handed out to other processes using tbselenium
+    socks_port = lease_port()
+    control_port = lease_port()
     tor_data_dir = tempfile.mkdtemp()
     tor_binary = join(tbb_dir, cm.DEFAULT_TOR_BINARY_PATH)
     print("SOCKS port: %s, Control port: %s" % (socks_port, control_port))
@@ -0,0 +1,15 @@
+#!/usr/bin/python
+import sys
+from os import environ
+from os.path import isdir
+
+
+if len(sys.argv) < 2 or not isdir(sys.argv[1]):
+    raise IOError("Please pass the path to Tor Browser Bundle")
+
+# TBB_PATH environment variable is used by the test package
+environ['TBB_PATH'] = sys.argv[1]
+
+from tbselenium.test.benchmark import main  # noqa: E402
+
+sys.exit(main())
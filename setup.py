@@ -15,5 +15,8 @@ setup(
     packages=["tbselenium", "tbselenium.test"],
     install_requires=[
         "selenium>=4"
-    ]
+    ],
+    entry_points={
+        "console_scripts": ["tbselenium-reaper=tbselenium.reaper:main"]
+    }
 )
@@ -0,0 +1,131 @@
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from selenium.webdriver.common.by import By
+from tbselenium.tbdriver import TorBrowserDriver
+
+
+DEFAULT_MAX_WORKERS = 32
+_default_executor = None
+
+
+def get_default_executor():
+    """Return the executor shared by the browsers that aren't given one."""
+    global _default_executor
+    if _default_executor is None:
+        _default_executor = ThreadPoolExecutor(
+            max_workers=DEFAULT_MAX_WORKERS,
+            thread_name_prefix="tbselenium")
+    return _default_executor
+
+
+def retrieve_exception(future):
+    """Mark the exception of an abandoned future as retrieved."""
+    if not future.cancelled():
+        future.exception()
+
+
+def quit_when_done(future):
+    """Quit the driver a cancelled launch returns.
+
+    This runs on the event loop, so the driver quits in the background.
+    """
+    if not future.cancelled() and future.exception() is None:
+        future.result().quit(block=False)
+
+
+class AsyncTorBrowser(object):
+    """Drive a TorBrowserDriver from asyncio.
+
+    Blocking driver calls run on a bounded executor, so that one event loop
+    can keep many browsers busy. Pass the same `semaphore` to several
+    browsers to limit how many of their calls run at once. If a call is
+    cancelled, the browser is killed, since the blocking call can't be
+    interrupted otherwise:
+
+        browser = await AsyncTorBrowser.launch(tbb_path)
+        try:
+            await asyncio.wait_for(browser.load_url(url), timeout=60)
+        finally:
+            await browser.quit()
+    """
+    def __init__(self, driver, executor=None, semaphore=None):
+        self.driver = driver
+        self.executor = executor or get_default_executor()
+        self.semaphore = semaphore
+
+    @classmethod
+    async def launch(cls, *args, executor=None, semaphore=None,
+                     driver_class=TorBrowserDriver, **kwargs):
+        """Launch a driver on the executor and wrap it.
+
+        The launch counts against the `semaphore` like the other calls.
+        """
+        executor = executor or get_default_executor()
+        launch = partial(driver_class, *args, **kwargs)
+        if semaphore is None:
+            driver = await cls._launch(executor, launch)
+        else:
+            async with semaphore:
+                driver = await cls._launch(executor, launch)
+        return cls(driver, executor, semaphore)
+
+    @staticmethod
+    async def _launch(executor, launch):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor, launch)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the launch goes on in the executor, quit the browser after
+            future.add_done_callback(quit_when_done)
+            raise
+
+    async def run(self, func, *args, **kwargs):
+        """Run the blocking function on the executor.
+
+        Kill the browser if we are cancelled while waiting for it.
+        """
+        if self.semaphore is None:
+            return await self._run(func, *args, **kwargs)
+        async with self.semaphore:
+            return await self._run(func, *args, **kwargs)
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.executor, partial(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the call fails once the browser is gone, ignore its error
+            future.add_done_callback(retrieve_exception)
+            # use the loop's default executor, ours may be busy with hung calls
+            await loop.run_in_executor(None, self.driver.kill)
+            raise
+
+    async def load_url(self, url, **kwargs):
+        return await self.run(self.driver.load_url, url, **kwargs)
+
+    async def find_element_by(self, selector, timeout=30,
+                              find_by=By.CSS_SELECTOR):
+        return await self.run(self.driver.find_element_by, selector,
+                              timeout, find_by)
+
+    async def execute_script(self, script, *args):
+        return await self.run(self.driver.execute_script, script, *args)
+
+    async def get_screenshot_as_png(self):
+        return await self.run(self.driver.get_screenshot_as_png)
+
+    async def get_screenshot_as_file(self, filename):
+        return await self.run(self.driver.get_screenshot_as_file, filename)
+
+    async def quit(self):
+        return await self.run(self.driver.quit)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.quit()
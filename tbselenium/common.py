@@ -1,5 +1,6 @@
 from os.path import join, dirname, abspath
-from os import environ
+from os import environ, getuid
+from tempfile import gettempdir
 
 # DEFAULT TBB PATHS works for TBB versions v4.x and above
 # Old TBB versions (V3.X or below) have different directory structures
@@ -14,10 +15,18 @@ DEFAULT_TBB_PROFILE_PATH = join(DEFAULT_TBB_DATA_DIR, 'Browser',
 DEFAULT_TOR_DATA_PATH = join(DEFAULT_TBB_DATA_DIR, 'Tor')
 TB_CHANGE_LOG_PATH = join(DEFAULT_TBB_TORBROWSER_DIR,
                           'Docs', 'ChangeLog.txt')
-# noscript .xpi path as found in the TBB distributions
+# noscript add-on ID and .xpi path as found in the TBB distributions
+NO_SCRIPT_ADDON_ID = '{73a6fe31-595d-460b-a920-fcc0f8843232}'
 DEFAULT_TBB_NO_SCRIPT_XPI_PATH = join(
     DEFAULT_TBB_PROFILE_PATH, 'extensions',
-    '{73a6fe31-595d-460b-a920-fcc0f8843232}.xpi')
+    '%s.xpi' % NO_SCRIPT_ADDON_ID)
+
+# Per-user directory for the files we share between processes. Only the
+# current user can access it, so others can't plant files in it.
+TBSELENIUM_TMP_DIR = join(gettempdir(), 'tbselenium-%d' % getuid())
+
+# Suggested directory for storing encoded profiles, see profile_cache_dir
+DEFAULT_PROFILE_CACHE_DIR = join(TBSELENIUM_TMP_DIR, 'profile-cache')
 
 # Directories for bundled fonts - Linux only
 DEFAULT_FONTCONFIG_PATH = join(DEFAULT_TBB_DATA_DIR, 'fontconfig')
@@ -37,16 +46,48 @@ TBB_CONTROL_PORT = 9151
 STEM_SOCKS_PORT = 9250
 STEM_CONTROL_PORT = 9251
 
+# Files in tor's DataDirectory that we reuse to speed up bootstrapping
+TOR_CONSENSUS_FILE = 'cached-microdesc-consensus'
+TOR_DATA_SEED_FILES = [TOR_CONSENSUS_FILE, 'cached-consensus',
+                       'cached-microdescs', 'cached-microdescs.new',
+                       'cached-certs']
+# Suggested directory for the DataDirectory seed, see data_dir_seed
+DEFAULT_TOR_DATA_SEED_DIR = join(TBSELENIUM_TMP_DIR, 'tor-data-seed')
+# Refresh the seed if its consensus is older than an hour, as directory
+# authorities publish a new consensus every hour.
+TOR_DATA_SEED_MAX_AGE = 3600
+
+# Lock files that make port leases visible to other processes
+PORT_LOCK_DIR = join(TBSELENIUM_TMP_DIR, 'port-locks')
+
+# Each running driver writes a marker with its processes and directories
+# here, see tbselenium.reaper
+OWNER_MARKER_DIR = join(TBSELENIUM_TMP_DIR, 'owners')
+
 KNOWN_SOCKS_PORTS = [DEFAULT_SOCKS_PORT, TBB_SOCKS_PORT]
 PORT_BAN_PREFS = ["extensions.torbutton.banned_ports",
                   "network.security.ports.banned"]
 
 
+# Max. seconds to wait for the browser UI and add-ons to initialize
+BROWSER_READY_TIMEOUT = 30
+
+# Max. seconds load_url waits for the page completion criteria
+PAGE_COMPLETION_TIMEOUT = 30
+
+# Seconds a background teardown waits for the browser to quit before
+# killing it, see TorBrowserDriver.quit
+QUIT_TIMEOUT = 30
+
+# Max. number of tor events kept per visit, see TorEventRecorder
+TOR_EVENT_BUFFER_SIZE = 10000
+
 # Test constants
 CHECK_TPO_URL = "http://check.torproject.org"
 CHECK_TPO_HOST = "check.torproject.org"
 TEST_URL = CHECK_TPO_URL
 ABOUT_TOR_URL = "about:tor"
+ABOUT_BLANK_URL = "about:blank"
 
 # Which tor process/binary to use
 LAUNCH_NEW_TBB_TOR = 0  # Not supported (use tor in TBB, launch a new process)
@@ -25,3 +25,15 @@ class TorBrowserDriverInitError(Exception):
 
 class StemLaunchError(Exception):
     pass
+
+
+class TBDriverPoolError(Exception):
+    pass
+
+
+class TorFleetError(Exception):
+    pass
+
+
+class TBDriverRamDirError(Exception):
+    pass
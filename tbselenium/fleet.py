@@ -0,0 +1,169 @@
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import tbselenium.common as cm
+from tbselenium.utils import launch_tbb_tor_with_stem, is_busy
+from tbselenium.ramdir import make_ram_dir
+from tbselenium.ports import lease_port, release_port
+from tbselenium.exceptions import TorFleetError
+
+
+DEFAULT_FLEET_SIZE = 2
+
+
+class TorInstance(object):
+    """A tor process launched by TorFleet and the browsers assigned to it."""
+    def __init__(self, process, socks_port, control_port, data_dir):
+        self.process = process
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.data_dir = data_dir
+        self.load = 0  # number of browsers currently using this instance
+
+    def is_healthy(self):
+        """Return True if tor is running and its SOCKS port is listening."""
+        return self.process.poll() is None and is_busy(self.socks_port)
+
+    @property
+    def driver_kwargs(self):
+        """Arguments to connect a TorBrowserDriver to this instance."""
+        return {"tor_cfg": cm.USE_STEM,
+                "socks_port": self.socks_port,
+                "control_port": self.control_port}
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        release_port(self.socks_port)
+        release_port(self.control_port)
+
+
+class TorFleet(object):
+    """Launch several tor processes and spread browsers over them.
+
+    A single tor process becomes a bottleneck for circuit building and
+    bandwidth when many browsers share it. Each instance in the fleet gets
+    its own ports and DataDirectory, and lease() hands out the healthy
+    instance that serves the fewest browsers:
+
+        with TorFleet(tbb_path, size=3) as fleet:
+            with fleet.lease() as tor:
+                with TorBrowserDriver(tbb_path, **tor.driver_kwargs) as driver:
+                    driver.load_url(url)
+
+    `torrc` holds extra options that are passed to every instance.
+    `data_dir_seed` is passed to launch_tbb_tor_with_stem, so that new
+    instances start from the cached consensus and descriptors.
+    If `ram_dir` is given, the DataDirectories are created under it, see
+    tbselenium.ramdir.make_ram_dir.
+    """
+    def __init__(self, tbb_path=None, size=DEFAULT_FLEET_SIZE,
+                 tor_binary=None, torrc=None, data_dir_seed=None,
+                 ram_dir="", ram_dir_budget=None):
+        if size < 1:
+            raise TorFleetError("Fleet size should be at least 1: %s" % size)
+        self.tbb_path = tbb_path
+        self.size = size
+        self.tor_binary = tor_binary
+        self.torrc = torrc or {}
+        self.data_dir_seed = data_dir_seed
+        self.ram_dir = ram_dir
+        self.ram_dir_budget = ram_dir_budget
+        self.instances = []
+        self._lock = threading.Lock()
+
+    def launch_instance(self):
+        """Launch a tor process on leased ports with a new DataDirectory."""
+        if self.ram_dir:
+            data_dir = make_ram_dir(self.ram_dir, self.ram_dir_budget)
+        else:
+            data_dir = tempfile.mkdtemp()
+        socks_port = lease_port()
+        control_port = lease_port()
+        torrc = dict(self.torrc)
+        torrc.update({'ControlPort': str(control_port),
+                      'SOCKSPort': str(socks_port),
+                      'DataDirectory': data_dir})
+        try:
+            process = launch_tbb_tor_with_stem(
+                tbb_path=self.tbb_path, torrc=torrc,
+                tor_binary=self.tor_binary, data_dir_seed=self.data_dir_seed)
+        except Exception:
+            shutil.rmtree(data_dir, ignore_errors=True)
+            release_port(socks_port)
+            release_port(control_port)
+            raise
+        return TorInstance(process, socks_port, control_port, data_dir)
+
+    def start(self):
+        """Launch the tor processes in parallel, as bootstrapping each
+        of them takes a while."""
+        missing = self.size - len(self.instances)
+        if missing <= 0:
+            return
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [executor.submit(self.launch_instance)
+                       for _ in range(missing)]
+        errors = []
+        for future in futures:
+            if future.exception() is None:
+                self.instances.append(future.result())
+            else:
+                errors.append(future.exception())
+        if errors:
+            self.stop()
+            raise TorFleetError("Cannot launch %s tor processes: %s"
+                                % (self.size, errors[0]))
+
+    def check_health(self):
+        """Replace the instances whose tor process died or stopped listening.
+
+        Return the replaced instances.
+        """
+        unhealthy = [tor for tor in self.instances if not tor.is_healthy()]
+        for tor in unhealthy:
+            tor.kill()
+            new_tor = self.launch_instance()
+            with self._lock:
+                self.instances[self.instances.index(tor)] = new_tor
+        return unhealthy
+
+    def acquire(self):
+        """Return the healthy instance with the fewest browsers."""
+        with self._lock:
+            for tor in sorted(self.instances, key=lambda tor: tor.load):
+                if tor.is_healthy():
+                    tor.load += 1
+                    return tor
+        raise TorFleetError("No healthy tor instance available")
+
+    def release(self, tor):
+        with self._lock:
+            tor.load = max(0, tor.load - 1)
+
+    @contextmanager
+    def lease(self):
+        """Acquire an instance and release it when done."""
+        tor = self.acquire()
+        try:
+            yield tor
+        finally:
+            self.release(tor)
+
+    def stop(self):
+        """Kill all tor processes and remove their data directories."""
+        with self._lock:
+            for tor in self.instances:
+                tor.kill()
+            self.instances = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
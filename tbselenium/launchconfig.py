@@ -0,0 +1,221 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from os.path import isdir, isfile, join
+from types import MappingProxyType
+import tbselenium.common as cm
+from tbselenium.profile import hash_profile_dir
+from tbselenium.utils import TB_SECURITY_SLIDER_PREF, TB_SECURITY_SLIDER_VALUES
+
+
+DEFAULT_BANNED_PORTS = "9050,9051,9150,9151"
+# Configs kept by TBLaunchConfig.get(). The key includes the ports, which
+# change with each launch when they are leased, e.g. with record_traffic.
+MAX_CACHED_CONFIGS = 32
+
+# Turn off Firefox background work that a crawler doesn't need. We don't
+# touch the prefs that Tor Browser sets for privacy or security.
+LEAN_PREFS = {
+    # session store writes to the profile every 15 seconds
+    'browser.sessionstore.interval': 3600000,
+    'browser.sessionstore.resume_from_crash': False,
+    'browser.sessionstore.max_tabs_undo': 0,
+    'browser.sessionstore.max_windows_undo': 0,
+    # prefetch and speculative connections
+    'network.prefetch-next': False,
+    'network.dns.disablePrefetch': True,
+    'network.predictor.enabled': False,
+    'network.predictor.enable-prefetch': False,
+    'network.http.speculative-parallel-limit': 0,
+    'browser.urlbar.speculativeConnect.enabled': False,
+    'browser.places.speculativeConnect.enabled': False,
+    # caches
+    'browser.cache.disk.enable': False,
+    'browser.sessionhistory.max_total_viewers': 0,
+    'browser.pagethumbnails.capturing_disabled': True,
+    # idle processes and UI work
+    'dom.ipc.processPrelaunch.enabled': False,
+    'toolkit.cosmeticAnimations.enabled': False,
+    'browser.shell.checkDefaultBrowser': False,
+    'accessibility.force_disabled': 1,
+    }
+
+PREF_PRESETS = {"lean": LEAN_PREFS}
+
+
+def add_ports_to_fx_banned_ports(prefs, socks_port, control_port):
+    """By default, ports 9050,9051,9150,9151 are banned in TB.
+
+    If we use a tor process running on a custom SOCKS port, we add SOCKS
+    and control ports to the following prefs:
+        network.security.ports.banned
+        extensions.torbutton.banned_ports
+    """
+    if socks_port in cm.KNOWN_SOCKS_PORTS:
+        return
+    for port_ban_pref in cm.PORT_BAN_PREFS:
+        banned_ports = prefs.get(port_ban_pref, DEFAULT_BANNED_PORTS)
+        prefs[port_ban_pref] = "%s,%s,%s" % (banned_ports, socks_port,
+                                             control_port)
+
+
+def add_prefs_for_using_system_tor(prefs, socks_port, control_port):
+    """Set the preferences suggested by start-tor-browser script
+    to run TB with system-installed Tor.
+
+    We set these prefs for running with Tor started with Stem as well.
+    """
+    # Prevent Tor Browser running its own Tor process
+    prefs['extensions.torlauncher.start_tor'] = False
+    # TODO: investigate whether these prefs are up to date or not
+    prefs['extensions.torbutton.block_disk'] = False
+    prefs['extensions.torbutton.custom.socks_host'] = '127.0.0.1'
+    prefs['extensions.torbutton.custom.socks_port'] = socks_port
+    prefs['extensions.torbutton.inserted_button'] = True
+    prefs['extensions.torbutton.launch_warning'] = False
+    prefs['privacy.spoof_english'] = 2
+    prefs['extensions.torbutton.loglevel'] = 2
+    prefs['extensions.torbutton.logmethod'] = 0
+    prefs['extensions.torbutton.settings_method'] = 'custom'
+    prefs['extensions.torbutton.use_privoxy'] = False
+    prefs['extensions.torlauncher.control_port'] = control_port
+    prefs['extensions.torlauncher.loglevel'] = 2
+    prefs['extensions.torlauncher.logmethod'] = 0
+    prefs['extensions.torlauncher.prompt_at_startup'] = False
+    # disable XPI signature checking
+    prefs['xpinstall.signatures.required'] = False
+    prefs['xpinstall.whitelist.required'] = False
+
+
+def apply_pref_preset(preset, pref_dict):
+    """Return the preset prefs updated with pref_dict."""
+    prefs = dict(PREF_PRESETS[preset]) if preset else {}
+    prefs.update(pref_dict)
+    return prefs
+
+
+def build_tb_prefs(socks_port, control_port, default_bridge_type="",
+                   pref_dict={}, security_level=None,
+                   page_load_strategy="normal", base_prefs={}):
+    """Return the prefs we launch Tor Browser with.
+
+    `base_prefs` are the prefs that were already set on the Options, and
+    `pref_dict` overwrites all other preferences.
+    """
+    prefs = dict(base_prefs)
+    add_ports_to_fx_banned_ports(prefs, socks_port, control_port)
+    prefs['browser.startup.page'] = "0"
+    prefs['torbrowser.settings.quickstart.enabled'] = True
+    prefs['browser.startup.homepage'] = 'about:newtab'
+    prefs['extensions.torlauncher.prompt_at_startup'] = 0
+    # load strategy normal is equivalent to "onload"
+    prefs['webdriver.load.strategy'] = page_load_strategy
+    # disable auto-update
+    prefs['app.update.enabled'] = False
+    prefs['extensions.torbutton.versioncheck_enabled'] = False
+    if default_bridge_type:
+        # to use a non-default bridge, overwrite the relevant pref, e.g.:
+        # extensions.torlauncher.default_bridge.meek-azure.1 = meek 0.0....
+        prefs['extensions.torlauncher.default_bridge_type'] = \
+            default_bridge_type
+
+    prefs['extensions.torbutton.prompted_language'] = True
+    # https://gitlab.torproject.org/tpo/applications/tor-browser/-/issues/41378
+    prefs['intl.language_notification.shown'] = True
+    # Configure Firefox to use Tor SOCKS proxy
+    prefs['network.proxy.socks_port'] = socks_port
+    prefs['extensions.torbutton.socks_port'] = socks_port
+    prefs['extensions.torlauncher.control_port'] = control_port
+    add_prefs_for_using_system_tor(prefs, socks_port, control_port)
+    if security_level:
+        prefs[TB_SECURITY_SLIDER_PREF] = \
+            TB_SECURITY_SLIDER_VALUES[security_level]
+    # pref_dict overwrites above preferences
+    for pref_name, pref_val in pref_dict.items():
+        prefs[pref_name] = pref_val
+    return prefs
+
+
+class TBLaunchConfig(object):
+    """Frozen set of launch prefs, computed once and shared by the drivers.
+
+    Use TBLaunchConfig.get() to reuse the config that was built for the
+    same arguments in this process. TorBrowserDriver does this for you.
+    The last MAX_CACHED_CONFIGS configs are kept.
+
+    The prefs can also be baked into a copy of the profile as user.js,
+    which can then be passed to TorBrowserDriver as `tbb_profile_path`:
+
+        config = TBLaunchConfig.get(socks_port, control_port)
+        template = config.make_profile_template(profile_dir, template_root)
+    """
+    _configs = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, socks_port, control_port, default_bridge_type="",
+                 pref_dict={}, security_level=None,
+                 page_load_strategy="normal", base_prefs={}):
+        self.socks_port = socks_port
+        self.control_port = control_port
+        self.prefs = MappingProxyType(build_tb_prefs(
+            socks_port, control_port, default_bridge_type, pref_dict,
+            security_level, page_load_strategy, base_prefs))
+
+    @classmethod
+    def get(cls, socks_port, control_port, default_bridge_type="",
+            pref_dict={}, security_level=None, page_load_strategy="normal",
+            base_prefs={}):
+        """Return the shared config for the given arguments."""
+        key = (socks_port, control_port, default_bridge_type,
+               tuple(sorted(pref_dict.items())), security_level,
+               page_load_strategy, tuple(sorted(base_prefs.items())))
+        with cls._lock:
+            if key in cls._configs:
+                cls._configs.move_to_end(key)
+                return cls._configs[key]
+            config = cls._configs[key] = cls(
+                socks_port, control_port, default_bridge_type, pref_dict,
+                security_level, page_load_strategy, base_prefs)
+            if len(cls._configs) > MAX_CACHED_CONFIGS:
+                cls._configs.popitem(last=False)
+            return config
+
+    def user_js(self):
+        """Render the prefs in the user.js format."""
+        return "".join('user_pref("%s", %s);\n' % (name, json.dumps(value))
+                       for name, value in self.prefs.items())
+
+    def make_profile_template(self, profile_dir, template_root):
+        """Return a copy of the profile with the prefs written to user.js.
+
+        The template is created once per profile content and prefs, and
+        reused by later calls, including the ones in other processes.
+        """
+        template_dir = join(template_root,
+                            hash_profile_dir(profile_dir, dict(self.prefs)))
+        if isdir(template_dir):
+            return template_dir
+        os.makedirs(template_root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=template_root)
+        try:
+            tmp_profile_dir = join(tmp_dir, "profile")
+            shutil.copytree(profile_dir, tmp_profile_dir,
+                            ignore=shutil.ignore_patterns(
+                                "parent.lock", "lock", ".parentlock"))
+            user_js_path = join(tmp_profile_dir, "user.js")
+            # later user_pref calls overwrite the ones in the existing user.js
+            mode = "a" if isfile(user_js_path) else "w"
+            with open(user_js_path, mode) as f:
+                f.write(self.user_js())
+            try:
+                os.rename(tmp_profile_dir, template_dir)
+            except OSError:
+                # another process created the template in the meantime
+                if not isdir(template_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return template_dir
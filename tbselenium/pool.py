@@ -0,0 +1,222 @@
+import copy
+import threading
+from time import monotonic
+from contextlib import contextmanager
+from queue import Queue, Empty
+from tbselenium.tbdriver import TorBrowserDriver
+from tbselenium.exceptions import TBDriverPoolError
+
+
+DEFAULT_POOL_SIZE = 2
+DEFAULT_MAX_VISITS_PER_DRIVER = 50
+# seconds between the attempts to replace a driver that failed to launch
+RELAUNCH_RETRY_INTERVAL = 5
+# seconds lease() waits for an idle driver before retrying launches
+LEASE_POLL_INTERVAL = 1
+
+
+def reset_driver_state(driver):
+    """Bring a driver back to a clean state between two leases.
+
+    Close all windows but the first one, clear the browsing data and go
+    back to a blank page. Pass `reset_fn=lambda d: d.new_identity()` to
+    the pool to get new circuits for each lease as well.
+    """
+    if not driver.new_identity(newnym=False):
+        raise TBDriverPoolError("Cannot clear the browsing data")
+
+
+class TorBrowserDriverPool(object):
+    """Keep a number of live TorBrowserDriver instances and lease them out.
+
+    Launching Tor Browser takes seconds, which is often as long as a visit
+    under Tor. The pool launches the browsers once and reuses them across
+    visits. Drivers are reset between leases, and replaced with a fresh
+    one after `max_visits` leases, when the RSS of the browser processes
+    exceeds `max_rss` bytes (requires psutil) or when a lease ends with an
+    exception.
+
+        with TorBrowserDriverPool(tbb_path, size=3) as pool:
+            with pool.lease() as driver:
+                driver.load_url(url)
+
+    All other keyword arguments are passed to the driver class.
+    """
+    def __init__(self, tbb_path="", size=DEFAULT_POOL_SIZE,
+                 max_visits=DEFAULT_MAX_VISITS_PER_DRIVER, max_rss=None,
+                 driver_class=TorBrowserDriver, reset_fn=reset_driver_state,
+                 **driver_kwargs):
+        if size < 1:
+            raise TBDriverPoolError("Pool size should be at least 1: %s"
+                                    % size)
+        self.tbb_path = tbb_path
+        self.size = size
+        self.max_visits = max_visits
+        self.max_rss = max_rss
+        self.driver_class = driver_class
+        self.reset_fn = reset_fn
+        self.driver_kwargs = driver_kwargs
+        self.is_running = False
+        self._idle = Queue()
+        self._visits = {}  # maps id(driver) to the number of leases
+        self._drivers = []
+        # number of drivers that quit and are not replaced yet
+        self._missing = 0
+        self._last_launch_failure = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Launch the browsers."""
+        self.is_running = True
+        for _ in range(self.size - len(self._drivers)):
+            self._idle.put(self._launch())
+
+    def _launch(self):
+        driver_kwargs = dict(self.driver_kwargs)
+        if driver_kwargs.get("options") is not None:
+            # the driver adds its arguments and prefs to the options
+            driver_kwargs["options"] = copy.deepcopy(driver_kwargs["options"])
+        driver = self.driver_class(self.tbb_path, **driver_kwargs)
+        with self._lock:
+            self._drivers.append(driver)
+            self._visits[id(driver)] = 0
+        return driver
+
+    def _discard(self, driver, block=True):
+        """Quit the driver and forget about it."""
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+            self._visits.pop(id(driver), None)
+        try:
+            driver.quit(block=block)
+        except Exception as e:
+            print("[tbselenium] Exception while quitting: %s" % e)
+
+    def _recycle(self, driver, relaunch=True):
+        """Replace the driver with a freshly launched one. The old driver
+        quits in the background, while the new one launches.
+
+        With relaunch=False, the replacement is launched by the next lease.
+        """
+        self._discard(driver, block=False)
+        with self._lock:
+            self._missing += 1
+        if relaunch:
+            self._refill()
+
+    def _refill(self):
+        """Launch the missing drivers. Launch errors are printed, and the
+        launch is retried after RELAUNCH_RETRY_INTERVAL seconds."""
+        with self._lock:
+            if self._last_launch_failure is not None and \
+                    monotonic() - self._last_launch_failure < \
+                    RELAUNCH_RETRY_INTERVAL:
+                return
+        while self.is_running:
+            with self._lock:
+                if not self._missing:
+                    return
+                self._missing -= 1
+            try:
+                driver = self._launch()
+            except Exception as e:
+                print("[tbselenium] Cannot launch a driver for the pool: %s"
+                      % e)
+                with self._lock:
+                    self._missing += 1
+                    self._last_launch_failure = monotonic()
+                return
+            with self._lock:
+                self._last_launch_failure = None
+            self._idle.put(driver)
+
+    def _checkin(self, driver):
+        if not self.is_running or id(driver) not in self._visits:
+            # pool was closed while the driver was leased
+            return self._discard(driver)
+        self._visits[id(driver)] += 1
+        if self.should_recycle(driver):
+            return self._recycle(driver)
+        try:
+            self.reset_fn(driver)
+        except Exception as e:
+            print("[tbselenium] Cannot reset the driver: %s" % e)
+            return self._recycle(driver)
+        self._idle.put(driver)
+
+    def should_recycle(self, driver):
+        """Return True if the driver served enough visits or uses too much
+        memory."""
+        if self._visits[id(driver)] >= self.max_visits:
+            return True
+        if self.max_rss is None:
+            return False
+        usage = driver.resource_usage()
+        if usage is None:
+            print("[tbselenium] Recycling the driver, its processes are gone")
+            return True
+        if usage["rss"] > self.max_rss:
+            print("[tbselenium] Recycling the driver, RSS is over %s bytes"
+                  % self.max_rss)
+            return True
+        return False
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """Check out a driver, and return it to the pool when done.
+
+        Raise TBDriverPoolError if no driver becomes available
+        within `timeout` seconds, or if the pool has no drivers left
+        because they can't be launched.
+        """
+        if not self.is_running:
+            raise TBDriverPoolError("Pool is not running")
+        driver = self._get_idle(timeout)
+        try:
+            yield driver
+        except BaseException:
+            # don't delay or mask the exception with a launch
+            self._recycle(driver, relaunch=False)
+            raise
+        self._checkin(driver)
+
+    def _get_idle(self, timeout):
+        """Wait for an idle driver, launching the missing ones meanwhile."""
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            self._refill()
+            with self._lock:
+                no_drivers = not self._drivers
+            if no_drivers and self._idle.empty():
+                raise TBDriverPoolError("No driver could be launched")
+            wait = LEASE_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - monotonic())
+                if wait <= 0:
+                    raise TBDriverPoolError(
+                        "No driver available after %s seconds" % timeout)
+            try:
+                return self._idle.get(timeout=wait)
+            except Empty:
+                continue
+
+    def visit_count(self, driver):
+        """Return the number of leases the driver served so far."""
+        return self._visits.get(id(driver), 0)
+
+    def close(self):
+        """Quit all drivers, including the ones that are currently leased."""
+        self.is_running = False
+        for driver in list(self._drivers):
+            self._discard(driver)
+        self._missing = 0
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,100 @@
+import errno
+import fcntl
+import socket
+import threading
+from os.path import join
+from selenium.webdriver.common.utils import free_port
+import tbselenium.common as cm
+from tbselenium.exceptions import TBDriverPortError, TBDriverPathError
+from tbselenium.utils import make_private_dir
+
+
+MAX_PORT_LEASE_TRIES = 50
+
+_leases = {}  # maps leased ports to their open lock files
+_lock = threading.Lock()
+
+
+def is_port_bindable(port_no):
+    """Return True if we can bind to the port on localhost."""
+    skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        skt.bind(("127.0.0.1", port_no))
+        return True
+    except OSError:
+        return False
+    finally:
+        skt.close()
+
+
+def try_lock_port(port_no, lock_dir):
+    """Lock the port's lock file and return it, or None if it's locked.
+
+    flock locks are held until the file is closed, which the kernel does
+    for us if the process crashes.
+    """
+    lock_file = open(join(lock_dir, "%d.lock" % port_no), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError as e:
+        lock_file.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return lock_file
+
+
+def lease_port(lock_dir=cm.PORT_LOCK_DIR):
+    """Return a free port that no other process or thread holds.
+
+    free_port() alone may give the same port to several drivers or tor
+    processes launched at once, since the port is only bound later by
+    the browser or tor. We lock a file per port in `lock_dir` to make
+    the lease visible to other processes. The port is held until
+    release_port is called or the process exits.
+
+    If the lock files can't be used, the lease is only visible to this
+    process.
+    """
+    try:
+        make_private_dir(lock_dir)
+    except (OSError, TBDriverPathError) as e:
+        print("[tbselenium] Cannot use the port lock dir: %s" % e)
+        lock_dir = None
+    with _lock:
+        for _ in range(MAX_PORT_LEASE_TRIES):
+            port = free_port()
+            if port in _leases:
+                continue
+            lock_file = None
+            if lock_dir is not None:
+                try:
+                    lock_file = try_lock_port(port, lock_dir)
+                except OSError as e:
+                    print("[tbselenium] Cannot lock the port: %s" % e)
+                    lock_dir = None
+                else:
+                    if lock_file is None:  # leased by another process
+                        continue
+            # the port may have been bound since free_port returned
+            if not is_port_bindable(port):
+                if lock_file:
+                    lock_file.close()
+                continue
+            _leases[port] = lock_file
+            return port
+    raise TBDriverPortError("Cannot lease a free port")
+
+
+def release_port(port):
+    """Make the port available for leasing again."""
+    with _lock:
+        lock_file = _leases.pop(port, None)
+    if lock_file:
+        lock_file.close()
+
+
+def leased_ports():
+    """Return the ports leased by this process."""
+    with _lock:
+        return sorted(_leases)
@@ -0,0 +1,133 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from os.path import dirname, isfile, join, relpath
+from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+from tbselenium.exceptions import TBDriverPathError
+from tbselenium.utils import is_private_stat, make_private_dir
+
+# Encoded profiles kept in memory, each one takes a few MB
+MAX_MEMORY_CACHED_PROFILES = 4
+
+
+def hash_profile_dir(profile_dir, prefs=None):
+    """Return a hash that changes when the profile or the prefs change.
+
+    We hash the relative path, size and modification time of each file
+    rather than the file contents, so computing the hash does not cost
+    as much as encoding the profile.
+    """
+    digest = hashlib.sha256()
+    for base, dirs, files in os.walk(profile_dir):
+        dirs.sort()  # make the walk order deterministic
+        for file_name in sorted(files):
+            file_path = join(base, file_name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:  # e.g. a lock file that was just removed
+                continue
+            digest.update(("%s\0%d\0%d\0" % (
+                relpath(file_path, profile_dir), stat.st_size,
+                stat.st_mtime_ns)).encode("utf-8"))
+    digest.update(json.dumps(prefs or {}, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class CachedFirefoxProfile(FirefoxProfile):
+    """FirefoxProfile that encodes the profile once and reuses the result.
+
+    Selenium zips and base64-encodes the profile directory for each launch.
+    We keep the encoded profile in memory and in `cache_dir`, keyed by
+    hash_profile_dir, so that other launches and processes can reuse it.
+    Only the last MAX_MEMORY_CACHED_PROFILES profiles are kept in memory.
+
+    The profile directory is only read, never copied or written to.
+    The cache dir and the blobs are only trusted if they belong to the
+    current user and others can't write to them.
+    """
+    _memory_cache = OrderedDict()
+    _lock = threading.Lock()
+
+    def __init__(self, profile_directory, cache_dir):
+        # FirefoxProfile.__init__ would copy the whole profile to a tempdir
+        self._desired_preferences = {}
+        self._profile_dir = profile_directory
+        self.cache_dir = cache_dir
+
+    def update_preferences(self):
+        # prefs are written to a temporary copy in encode_profile
+        pass
+
+    @property
+    def cache_key(self):
+        return hash_profile_dir(self._profile_dir, self._desired_preferences)
+
+    @property
+    def encoded(self):
+        """Return the encoded profile from the cache, encode it on a miss."""
+        key = self.cache_key
+        with self._lock:
+            blob = self._memory_cache.get(key)
+        if blob is None:
+            blob = self.read_cached_blob(key)
+        if blob is None:
+            blob = self.encode_profile()
+            self.write_cached_blob(key, blob)
+        with self._lock:
+            self._memory_cache[key] = blob
+            self._memory_cache.move_to_end(key)
+            if len(self._memory_cache) > MAX_MEMORY_CACHED_PROFILES:
+                self._memory_cache.popitem(last=False)
+        return blob
+
+    def encode_profile(self):
+        """Encode a temporary copy of the profile with Selenium."""
+        profile = FirefoxProfile(self._profile_dir)
+        for pref_name, pref_val in self._desired_preferences.items():
+            profile.set_preference(pref_name, pref_val)
+        try:
+            return profile.encoded
+        finally:
+            shutil.rmtree(dirname(profile.path), ignore_errors=True)
+
+    def cached_blob_path(self, key):
+        return join(self.cache_dir, "%s.b64" % key)
+
+    def read_cached_blob(self, key):
+        blob_path = self.cached_blob_path(key)
+        try:
+            if not is_private_stat(os.stat(self.cache_dir)):
+                print("[tbselenium] Ignoring the profile cache, %s can be "
+                      "written by other users" % self.cache_dir)
+                return None
+            fd = os.open(blob_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:  # missing, or a symlink
+            return None
+        with os.fdopen(fd) as f:
+            if not is_private_stat(os.fstat(f.fileno())):
+                print("[tbselenium] Ignoring the cached profile %s, it can "
+                      "be written by other users" % blob_path)
+                return None
+            return f.read()
+
+    def write_cached_blob(self, key, blob):
+        """Write the blob atomically so concurrent launches never read
+        a partially written file."""
+        try:
+            make_private_dir(self.cache_dir)
+        except (OSError, TBDriverPathError) as e:
+            print("[tbselenium] Cannot write the profile cache: %s" % e)
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(blob)
+            os.replace(tmp_path, self.cached_blob_path(key))
+        except OSError as e:
+            print("[tbselenium] Cannot write the profile cache: %s" % e)
+            if isfile(tmp_path):
+                os.remove(tmp_path)
@@ -0,0 +1,51 @@
+import os
+import tempfile
+from os.path import isdir, join
+from tbselenium.exceptions import TBDriverRamDirError
+
+RAM_DIR_PREFIX = "tbselenium-"
+
+
+def get_dir_size(path):
+    """Return the total size of the files under path in bytes."""
+    size = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:  # removed in the meantime
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                size += get_dir_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return size
+
+
+def get_ram_dirs_size(ram_root):
+    """Return the size of the tbselenium directories under ram_root."""
+    return sum(get_dir_size(join(ram_root, name))
+               for name in os.listdir(ram_root)
+               if name.startswith(RAM_DIR_PREFIX))
+
+
+def make_ram_dir(ram_root, budget=None):
+    """Create a directory under a RAM-backed directory such as /dev/shm.
+
+    If `budget` is given, raise TBDriverRamDirError if the tbselenium
+    directories under ram_root, including the ones created by other
+    processes, already use `budget` bytes or more. The budget is only
+    checked here: it can't stop a running browser from writing more.
+    """
+    if not isdir(ram_root):
+        raise TBDriverRamDirError("RAM directory doesn't exist: %s"
+                                  % ram_root)
+    if budget is not None:
+        used = get_ram_dirs_size(ram_root)
+        if used >= budget:
+            raise TBDriverRamDirError(
+                "tbselenium uses %d bytes in %s, budget is %d bytes"
+                % (used, ram_root, budget))
+    return tempfile.mkdtemp(prefix=RAM_DIR_PREFIX, dir=ram_root)
@@ -0,0 +1,350 @@
+"""Clean up after drivers whose process died without quitting them.
+
+Each running driver writes an ownership marker to cm.OWNER_MARKER_DIR,
+with the PIDs of its own process, geckodriver and the browser, and the
+directories to remove. The marker is removed when the driver quits. A
+marker whose owner process is gone belongs to a crashed worker: reap
+them by running
+
+    python -m tbselenium.reaper
+
+e.g. from cron. Drivers that are still registered when their process
+exits, or gets SIGTERM or SIGHUP, are killed. Requires psutil.
+
+The marker dir is private to the user, and the reaper only trusts the
+markers of the current user. It only removes the geckodriver profiles
+and the RAM dirs of tbselenium, see is_reapable_dir.
+"""
+import os
+import sys
+import stat
+import json
+import atexit
+import signal
+import shutil
+import tempfile
+import threading
+import weakref
+from glob import glob
+from os.path import basename, dirname, join, getmtime
+from time import time
+from argparse import ArgumentParser
+import tbselenium.common as cm
+from tbselenium.exceptions import TBDriverPathError
+from tbselenium.ramdir import RAM_DIR_PREFIX
+from tbselenium.utils import kill_process_tree, is_private_stat, \
+    make_private_dir
+
+try:  # only needed for telling a process from a later one with its PID
+    import psutil
+except ImportError:
+    psutil = None
+
+# geckodriver creates the temporary profiles with this prefix
+PROFILE_DIR_PATTERN = "rust_mozprofile*"
+EXIT_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+_live_drivers = weakref.WeakSet()
+_lock = threading.Lock()
+_atexit_registered = False
+_signal_handlers_installed = False
+
+
+def get_create_time(pid):
+    """Return the creation time of the process, or None if it's gone."""
+    if psutil is None:
+        return None
+    try:
+        return psutil.Process(pid).create_time()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
+
+
+def is_same_process(pid, create_time):
+    """Return True if the recorded process is still running, and its PID
+    wasn't reused by another process."""
+    if not pid:
+        return False
+    current_create_time = get_create_time(pid)
+    if current_create_time is None:
+        return False
+    return create_time is None or current_create_time == create_time
+
+
+def write_owner_marker(driver, marker_dir=cm.OWNER_MARKER_DIR):
+    """Write the driver's ownership marker and return its path."""
+    make_private_dir(marker_dir)
+    geckodriver_pid = driver.service.process.pid
+    browser_pid = driver.capabilities.get("moz:processID")
+    dirs = [driver.ram_dir]
+    if not driver.use_custom_profile:
+        # never remove a stateful profile
+        dirs.append(driver.capabilities.get("moz:profile"))
+    marker = {
+        "owner_pid": os.getpid(),
+        "owner_create_time": get_create_time(os.getpid()),
+        "geckodriver_pid": geckodriver_pid,
+        "geckodriver_create_time": get_create_time(geckodriver_pid),
+        "browser_pid": browser_pid,
+        "browser_create_time": browser_pid and get_create_time(browser_pid),
+        "dirs": [d for d in dirs if d],
+        "created": time(),
+        }
+    marker_path = join(marker_dir, "%d.json" % geckodriver_pid)
+    fd, tmp_path = tempfile.mkstemp(dir=marker_dir, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(marker, f)
+    os.rename(tmp_path, marker_path)
+    return marker_path
+
+
+def register_driver(driver):
+    """Write the driver's marker and kill it if we exit before it quits."""
+    try:
+        driver.owner_marker = write_owner_marker(driver)
+    except (OSError, TBDriverPathError) as e:
+        # the driver is still killed at exit, but can't be reaped later
+        print("[tbselenium] Cannot write the owner marker: %s" % e)
+        driver.owner_marker = None
+    with _lock:
+        _live_drivers.add(driver)
+    install_exit_handlers()
+
+
+def unregister_driver(driver):
+    with _lock:
+        _live_drivers.discard(driver)
+    owner_marker = getattr(driver, "owner_marker", None)
+    if owner_marker:
+        try:
+            os.remove(owner_marker)
+        except FileNotFoundError:
+            pass
+        driver.owner_marker = None
+
+
+def live_drivers():
+    with _lock:
+        return list(_live_drivers)
+
+
+def kill_live_drivers():
+    # Don't take _lock: signal handlers run on the main thread, which may
+    # hold it already. Copying retries if another thread adds a driver.
+    while True:
+        try:
+            drivers = list(_live_drivers)
+            break
+        except RuntimeError:  # set changed size during iteration
+            continue
+    for driver in drivers:
+        try:
+            driver.kill()
+        except Exception as e:
+            print("[tbselenium] Exception while killing the driver: %s" % e)
+
+
+def handle_exit_signal(signum, frame):
+    kill_live_drivers()
+    # exit the way the signal would have made us exit
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+def install_exit_handlers():
+    """Kill the live drivers at exit and on SIGTERM and SIGHUP.
+
+    Signal handlers can only be installed from the main thread, and we
+    don't replace the handlers set by the application.
+    """
+    global _atexit_registered, _signal_handlers_installed
+    with _lock:
+        if not _atexit_registered:
+            atexit.register(kill_live_drivers)
+            _atexit_registered = True
+        if _signal_handlers_installed or \
+                threading.current_thread() is not threading.main_thread():
+            return
+        for signum in EXIT_SIGNALS:
+            if signal.getsignal(signum) == signal.SIG_DFL:
+                signal.signal(signum, handle_exit_signal)
+        _signal_handlers_installed = True
+
+
+def read_markers(marker_dir=cm.OWNER_MARKER_DIR):
+    """Return (path, marker) tuples for the markers in marker_dir.
+
+    Raise TBDriverPathError if the marker dir belongs to another user or
+    others can write to it. Skip the markers of other users.
+    """
+    try:
+        dir_stat = os.lstat(marker_dir)
+    except FileNotFoundError:
+        return []
+    if not stat.S_ISDIR(dir_stat.st_mode) or not is_private_stat(dir_stat):
+        raise TBDriverPathError("%s should be a directory of the current "
+                                "user that others can't write to"
+                                % marker_dir)
+    markers = []
+    for marker_path in glob(join(marker_dir, "*.json")):
+        try:
+            fd = os.open(marker_path, os.O_RDONLY | os.O_NOFOLLOW)
+        except OSError:  # removed, or a symlink
+            continue
+        with os.fdopen(fd) as f:
+            if not is_private_stat(os.fstat(f.fileno())):
+                print("[tbselenium] Skipping the marker of another user: %s"
+                      % marker_path)
+                continue
+            try:
+                markers.append((marker_path, json.load(f)))
+            except ValueError:  # being written
+                continue
+    return markers
+
+
+def is_orphan(marker):
+    """Return True if the owner process is surely gone.
+
+    A driver whose owner we can't check, e.g. without psutil or if we
+    can't access the process, is considered alive.
+    """
+    if psutil is None:
+        return False
+    try:
+        create_time = psutil.Process(marker["owner_pid"]).create_time()
+    except psutil.NoSuchProcess:
+        return True
+    except psutil.AccessDenied:
+        return False
+    owner_create_time = marker["owner_create_time"]
+    # a different create time means the PID was reused
+    return owner_create_time is not None and \
+        create_time != owner_create_time
+
+
+def is_own_dir(dir_path):
+    """Return True if dir_path is a directory, not a symlink, and it belongs
+    to the current user."""
+    try:
+        dir_stat = os.lstat(dir_path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(dir_stat.st_mode) and \
+        dir_stat.st_uid == os.getuid()
+
+
+def is_reapable_dir(dir_path, ram_dirs=()):
+    """Return True if dir_path is a directory that a driver would create.
+
+    That is one of our own RAM dirs, or one of our own geckodriver profiles
+    in the temp dir or in one of `ram_dirs`.
+    """
+    dir_path = os.path.normpath(dir_path)
+    name = basename(dir_path)
+    if name.startswith(RAM_DIR_PREFIX):
+        return is_own_dir(dir_path)
+    if name.startswith(PROFILE_DIR_PATTERN.rstrip("*")):
+        parents = [tempfile.gettempdir()] + list(ram_dirs)
+        return dirname(dir_path) in map(os.path.normpath, parents) and \
+            is_own_dir(dir_path)
+    return False
+
+
+def reap_marker(marker):
+    """Kill the processes and remove the directories of the marker."""
+    for name in ("geckodriver", "browser"):
+        pid = marker["%s_pid" % name]
+        if is_same_process(pid, marker["%s_create_time" % name]):
+            kill_process_tree(pid)
+    ram_dirs = [d for d in marker["dirs"]
+                if basename(os.path.normpath(d)).startswith(RAM_DIR_PREFIX)
+                and is_own_dir(d)]
+    for dir_path in marker["dirs"]:
+        if not os.path.lexists(dir_path):  # e.g. removed with its RAM dir
+            continue
+        if not is_reapable_dir(dir_path, ram_dirs):
+            print("[tbselenium] Not removing unexpected directory %s"
+                  % dir_path)
+            continue
+        shutil.rmtree(dir_path, ignore_errors=True)
+
+
+def reap_orphans(marker_dir=cm.OWNER_MARKER_DIR, dry_run=False):
+    """Reap the drivers whose owner process is gone.
+
+    Return the markers of the reaped drivers.
+    """
+    reaped = []
+    for marker_path, marker in read_markers(marker_dir):
+        if not is_orphan(marker):
+            continue
+        print("[tbselenium] Reaping the driver of dead process %s "
+              "(geckodriver %s)" % (marker["owner_pid"],
+                                    marker["geckodriver_pid"]))
+        if not dry_run:
+            reap_marker(marker)
+            os.remove(marker_path)
+        reaped.append(marker)
+    return reaped
+
+
+def reap_stale_profile_dirs(max_age, temp_dir=None,
+                            marker_dir=cm.OWNER_MARKER_DIR, dry_run=False):
+    """Remove the geckodriver profiles in temp_dir that are older than
+    `max_age` seconds and don't belong to a running driver.
+
+    This also catches the profiles left by drivers that ran before the
+    markers were written. The current user's profiles that other programs
+    run with geckodriver are removed too, so pick a generous max_age.
+    """
+    temp_dir = temp_dir or tempfile.gettempdir()
+    live_dirs = set()
+    for _, marker in read_markers(marker_dir):
+        if not is_orphan(marker):
+            live_dirs.update(marker["dirs"])
+    removed = []
+    for profile_dir in glob(join(temp_dir, PROFILE_DIR_PATTERN)):
+        try:
+            age = time() - getmtime(profile_dir)
+        except OSError:
+            continue
+        if not is_own_dir(profile_dir) or profile_dir in live_dirs or \
+                age < max_age:
+            continue
+        print("[tbselenium] Removing stale profile %s" % profile_dir)
+        if not dry_run:
+            shutil.rmtree(profile_dir, ignore_errors=True)
+        removed.append(profile_dir)
+    return removed
+
+
+def main(args=None):
+    parser = ArgumentParser(
+        description="Kill the browsers and remove the temporary profiles "
+                    "left by tbselenium processes that died")
+    parser.add_argument("--marker-dir", default=cm.OWNER_MARKER_DIR)
+    parser.add_argument("--profile-max-age", type=float,
+                        help="also remove %s dirs in the temp dir that are "
+                        "older than this many seconds" % PROFILE_DIR_PATTERN)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print what would be reaped")
+    args = parser.parse_args(args)
+    if psutil is None:
+        print("[tbselenium] The reaper requires psutil to tell the dead "
+              "processes from the live ones: pip install psutil")
+        return 1
+    try:
+        reap_orphans(args.marker_dir, args.dry_run)
+        if args.profile_max_age is not None:
+            reap_stale_profile_dirs(args.profile_max_age,
+                                    marker_dir=args.marker_dir,
+                                    dry_run=args.dry_run)
+    except TBDriverPathError as e:
+        print("[tbselenium] %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
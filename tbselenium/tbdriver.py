@@ -1,7 +1,8 @@
 import shutil
-from os import environ, chdir
+from os import environ
 from os.path import isdir, isfile, join, abspath, dirname
-from time import sleep
+from time import sleep, perf_counter, monotonic
+from contextlib import contextmanager
 from http.client import CannotSendRequest
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -9,17 +10,101 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.service import Service
 from selenium.webdriver.firefox.webdriver import WebDriver as FirefoxDriver
 from selenium.webdriver.firefox.options import Options
-from selenium.common.exceptions import WebDriverException
+from selenium.common.exceptions import WebDriverException, TimeoutException
 import tbselenium.common as cm
-from tbselenium.utils import prepend_to_env_var, is_busy
+from tbselenium.utils import (
+    prepend_to_env_var, is_busy, wait_for_browser_ready, kill_process_tree,
+    get_process_tree_usage, send_newnym, TB_SECURITY_LEVELS)
 from tbselenium.tbbinary import TBBinary
+from tbselenium.profile import CachedFirefoxProfile
+from tbselenium.launchconfig import (TBLaunchConfig, PREF_PRESETS,
+                                     apply_pref_preset)
+from tbselenium.watchdog import Watchdog
+from tbselenium.teardown import quit_in_background
+from tbselenium.reaper import register_driver, unregister_driver
+from tbselenium.ramdir import make_ram_dir
+from tbselenium.ports import lease_port, release_port
+from tbselenium.trace import SocksRecorder
+from tbselenium.torevents import TorEventRecorder
 from tbselenium.exceptions import (
     TBDriverConfigError, TBDriverPortError, TBDriverPathError)
 
 
-DEFAULT_BANNED_PORTS = "9050,9051,9150,9151"
 GECKO_DRIVER_EXE_PATH = shutil.which("geckodriver")
 
+# ms passed since the last response ended, 0 if the document is not loaded
+NETWORK_IDLE_TIME_SCRIPT = """
+const nav = performance.getEntriesByType("navigation")[0];
+if (!nav || !nav.responseEnd) return 0;
+let lastResponseEnd = nav.responseEnd;
+for (const entry of performance.getEntriesByType("resource")) {
+  lastResponseEnd = Math.max(lastResponseEnd, entry.responseEnd);
+}
+return performance.now() - lastResponseEnd;
+"""
+
+# changes with each new document, including reloads of the same URL
+DOCUMENT_TIME_ORIGIN_SCRIPT = "return performance.timeOrigin;"
+
+# error type of the about:neterror or about:certerror page, or null
+CONNECTION_ERROR_SCRIPT = """
+const uri = document.documentURI;
+if (!uri.startsWith("about:neterror") && !uri.startsWith("about:certerror"))
+  return null;
+const query = uri.includes("?") ? uri.slice(uri.indexOf("?")) : "";
+return new URLSearchParams(query).get("e") || "unknown";
+"""
+
+# Clear the browsing data, similar to Tor Browser's New Identity.
+# Flags missing in a given browser version are skipped.
+CLEAR_BROWSING_DATA_SCRIPT = """
+const done = arguments[arguments.length - 1];
+const clearDataFlags = [
+  "CLEAR_COOKIES", "CLEAR_DOM_QUOTA", "CLEAR_ALL_CACHES", "CLEAR_HISTORY",
+  "CLEAR_SESSION_HISTORY", "CLEAR_AUTH_TOKENS", "CLEAR_AUTH_CACHE",
+  "CLEAR_FORMDATA", "CLEAR_DOWNLOADS"];
+let flags = 0;
+for (const flag of clearDataFlags) {
+  flags |= Ci.nsIClearDataService[flag] || 0;
+}
+Services.obs.notifyObservers(null, "browser:purge-session-history");
+Services.obs.notifyObservers(null, "last-pb-context-exited");
+Services.clearData.deleteData(flags, {
+  onDataDeleted(failedFlags) {
+    done({failedFlags, cookies: Services.cookies.cookies.length});
+  }
+});
+"""
+
+
+class TBService(Service):
+    """Geckodriver service that records how long it takes to start.
+
+    Selenium passes a free_port() to geckodriver's --websocket-port. Pass
+    a leased `websocket_port` to use that instead, see tbselenium.ports.
+    """
+    start_duration = 0
+
+    def __init__(self, *args, websocket_port=None, **kwargs):
+        super(TBService, self).__init__(*args, **kwargs)
+        self.websocket_port = websocket_port
+
+    def command_line_args(self):
+        args = super(TBService, self).command_line_args()
+        if self.websocket_port:
+            if "--websocket-port" in args:
+                args[args.index("--websocket-port") + 1] = \
+                    str(self.websocket_port)
+            else:
+                args += ["--websocket-port", str(self.websocket_port)]
+        return args
+
+    def start(self):
+        t_start = perf_counter()
+        super(TBService, self).start()
+        self.start_duration = perf_counter() - t_start
+
+
 class TorBrowserDriver(FirefoxDriver):
     """
     Extend Firefox webdriver to automate Tor Browser.
@@ -40,7 +125,20 @@ class TorBrowserDriver(FirefoxDriver):
                  headless=False,
                  options=None,
                  use_custom_profile=False,
-                 geckodriver_port=0  # by default a random port will be used
+                 geckodriver_port=0,  # by default a free port is leased
+                 profile_cache_dir="",
+                 ready_timeout=cm.BROWSER_READY_TIMEOUT,
+                 startup_timings_callback=None,
+                 page_load_strategy="normal",
+                 security_level=None,
+                 marionette_port=None,
+                 record_traffic=False,
+                 record_tor_events=False,
+                 control_password=None,
+                 visit_record_callback=None,
+                 preset=None,
+                 ram_dir="",
+                 ram_dir_budget=None
                  ):
 
         # use_custom_profile: whether to launch from and *write to* the given
@@ -50,11 +148,63 @@ class TorBrowserDriver(FirefoxDriver):
         # a stateful profile across different launches of the Tor Browser.
         # It uses firefox's `-profile`` command line parameter under the hood
 
+        # profile_cache_dir: if given, reuse the zipped and base64-encoded
+        # profile stored in this directory instead of encoding the profile
+        # on every launch. Ignored if use_custom_profile is True.
+
+        # startup_timings_callback: called with the startup_timings dict
+        # once the browser is ready, e.g. to send the numbers to monitoring.
+
+        # page_load_strategy: "normal" (wait for the load event), "eager"
+        # (wait for DOMContentLoaded) or "none" (return right away). Combine
+        # "eager" or "none" with load_url's completion criteria.
+
+        # security_level: one of the utils.TB_SECURITY_LEVELS, set through
+        # the profile prefs at launch. Defaults to the profile's level.
+
+        # marionette_port: port for geckodriver's connection to the browser.
+        # Only used with use_custom_profile. By default, a free port is
+        # leased until quit, so that several stateful browsers can run.
+
+        # record_traffic: relay the browser's connections to the SOCKS port
+        # through a SocksRecorder, see traffic_trace.
+
+        # record_tor_events: record tor's CIRC, STREAM and BW events on
+        # control_port during each load_url (requires Stem). The summary of
+        # the last visit is kept in last_visit_record and passed to
+        # visit_record_callback. control_password authenticates to tor,
+        # here and in new_identity. The events of every client of the tor
+        # process are counted, so use a tor of its own for each browser.
+
+        # preset: name of a set of prefs in launchconfig.PREF_PRESETS, e.g.
+        # "lean" to turn off background work that crawls don't need.
+        # pref_dict overwrites the preset's prefs.
+
+        # ram_dir: a RAM-backed directory such as /dev/shm. If given, the
+        # temporary profile, the browser cache and other temporary files
+        # of the browser go into a new directory under ram_dir, which is
+        # removed on quit or kill. ram_dir_budget: refuse to launch if the
+        # tbselenium directories in ram_dir use this many bytes or more.
+
+        # duration of each startup phase in seconds, in the order they run
+        self.startup_timings = {}
         self.use_custom_profile = use_custom_profile
         self.tor_cfg = tor_cfg
-        self.setup_tbb_paths(tbb_path, tbb_fx_binary_path,
-                             tbb_profile_path, tor_data_dir)
+        self.control_password = control_password
+        self.page_load_strategy = page_load_strategy
+        if security_level not in [None] + TB_SECURITY_LEVELS:
+            raise TBDriverConfigError("Invalid Tor Browser security setting:"
+                                      " %s" % security_level)
+        # last level we set, used to skip redundant set_security_level calls
+        self.security_level = security_level
+        if preset not in [None] + list(PREF_PRESETS):
+            raise TBDriverConfigError("Unknown pref preset: %s" % preset)
+        self.preset = preset
+        with self.timed_phase("setup_tbb_paths"):
+            self.setup_tbb_paths(tbb_path, tbb_fx_binary_path,
+                                 tbb_profile_path, tor_data_dir)
         self.options = Options() if options is None else options
+        self.options.page_load_strategy = page_load_strategy
         install_noscript = False
 
         USE_DEPRECATED_PROFILE_METHOD = True
@@ -64,32 +214,17 @@ class TorBrowserDriver(FirefoxDriver):
             self.options.add_argument(self.tbb_profile_path)
         elif USE_DEPRECATED_PROFILE_METHOD:
             # launch from this custom profile
-            self.options.profile = self.tbb_profile_path
+            if profile_cache_dir:
+                self.options.profile = CachedFirefoxProfile(
+                    self.tbb_profile_path, profile_cache_dir)
+            else:
+                self.options.profile = self.tbb_profile_path
         else:
             # Launch with no profile at all. This should be used with caution.
             # NoScript does not come installed on browsers launched by this
             # method, so we install it ourselves
             install_noscript = True
 
-        self.init_ports(tor_cfg, socks_port, control_port)
-        self.init_prefs(pref_dict, default_bridge_type)
-        self.export_env_vars()
-        # TODO:
-        # self.binary = self.get_tb_binary(logfile=tbb_logfile_path)
-        if use_custom_profile:
-            print(f'Using custom profile: {self.tbb_profile_path}')
-            tbb_service = Service(
-                executable_path=executable_path,
-                log_path=tbb_logfile_path,  # TODO: deprecated, use log_output
-                service_args=["--marionette-port", "2828"],
-                port=geckodriver_port
-                )
-        else:
-            tbb_service = Service(
-                executable_path=executable_path,
-                log_path=tbb_logfile_path,
-                port=geckodriver_port
-                )
         # options.binary is path to the Firefox binary and it can be a string
         # or a FirefoxBinary object. If it's a string, it will be converted to
         # a FirefoxBinary object.
@@ -100,14 +235,131 @@ class TorBrowserDriver(FirefoxDriver):
         if headless:
             self.options.add_argument('-headless')
 
-        super(TorBrowserDriver, self).__init__(
-            service=tbb_service,
-            options=self.options,
-            )
+        with self.timed_phase("init_ports"):
+            self.init_ports(tor_cfg, socks_port, control_port)
+        self.socks_recorder = None
+        self.tor_event_recorder = None
+        self.ram_dir = None
+        # ports we hold until quit, see tbselenium.ports
+        self.leased_ports = []
+        try:
+            # the port the browser sends its traffic to
+            self.browser_socks_port = self.socks_port
+            if record_traffic:
+                self.socks_recorder = SocksRecorder(self.socks_port)
+                self.socks_recorder.start()
+                self.browser_socks_port = self.socks_recorder.port
+            with self.timed_phase("init_prefs"):
+                self.init_prefs(apply_pref_preset(preset, pref_dict),
+                                default_bridge_type)
+            if ram_dir:
+                self.ram_dir = make_ram_dir(ram_dir, ram_dir_budget)
+                # TB disables the disk cache, this is for when it's enabled.
+                # Set after init_prefs, so that the launch config is shared.
+                self.options.set_preference(
+                    "browser.cache.disk.parent_directory",
+                    join(self.ram_dir, "cache"))
+            with self.timed_phase("export_env_vars"):
+                self.export_env_vars()
+            # TODO:
+            # self.binary = self.get_tb_binary(logfile=tbb_logfile_path)
+            service_args = []
+            if use_custom_profile:
+                print(f'Using custom profile: {self.tbb_profile_path}')
+                if marionette_port is None:
+                    marionette_port = self.lease_port()
+                service_args = ["--marionette-port", str(marionette_port)]
+            self.marionette_port = marionette_port
+            if not geckodriver_port:
+                geckodriver_port = self.lease_port()
+            websocket_port = self.lease_port()
+            # geckodriver passes its environment and working directory on to
+            # the browser. We don't modify ours, so that drivers can be
+            # launched from several threads.
+            tbb_service = TBService(
+                executable_path=executable_path,
+                log_path=tbb_logfile_path,  # TODO: deprecated, use log_output
+                service_args=service_args,
+                port=geckodriver_port,
+                websocket_port=websocket_port,
+                env=self.tbb_env,
+                # TB can't find bundled "fonts" if we don't run in
+                # tbb_browser_dir
+                popen_kw={"cwd": self.tbb_browser_dir}
+                )
+            t_start = perf_counter()
+            super(TorBrowserDriver, self).__init__(
+                service=tbb_service,
+                options=self.options,
+                )
+        except BaseException:
+            # FirefoxDriver.__init__ quits if the session can't be created,
+            # but not if geckodriver fails to start or we are interrupted
+            self.stop_recorders()
+            self.remove_ram_dir()
+            self.release_ports()
+            service = getattr(self, "service", None)
+            if service is not None:
+                try:
+                    service.stop()
+                except Exception as e:
+                    print("[tbselenium] Exception while stopping "
+                          "geckodriver: %s" % e)
+            raise
+        # FirefoxDriver.__init__ starts the service and then the session
+        self.startup_timings["geckodriver_service"] = \
+            tbb_service.start_duration
+        self.startup_timings["session_handshake"] = \
+            perf_counter() - t_start - tbb_service.start_duration
         self.is_running = True
-        self.install_extensions(extensions, install_noscript)
-        self.temp_profile_dir = self.capabilities["moz:profile"]
-        sleep(1)
+        try:
+            # write our ownership marker, see tbselenium.reaper
+            register_driver(self)
+            with self.timed_phase("install_extensions"):
+                self.install_extensions(extensions, install_noscript)
+            self.temp_profile_dir = self.capabilities["moz:profile"]
+            # custom profiles may not come with NoScript installed
+            wait_for_noscript = install_noscript or \
+                not self.use_custom_profile
+            with self.timed_phase("wait_until_ready"):
+                self.wait_until_ready(ready_timeout, wait_for_noscript)
+            self.n_visits = 0
+            # (time, usage) of the last resource_usage call
+            self.last_usage_sample = None
+            self.last_visit_record = None
+            self.visit_record_callback = visit_record_callback
+            if record_tor_events:
+                self.tor_event_recorder = TorEventRecorder(
+                    self.control_port, control_password)
+                self.tor_event_recorder.start()
+            if startup_timings_callback:
+                startup_timings_callback(self.startup_timings)
+        except BaseException:
+            # don't leave the browser running if we can't return the driver
+            if self.is_running:
+                self.quit()
+            raise
+
+    @contextmanager
+    def timed_phase(self, phase):
+        """Record how long the enclosed startup phase takes."""
+        t_start = perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[phase] = perf_counter() - t_start
+
+    def wait_until_ready(self, timeout, wait_for_noscript=True):
+        """Wait until the browser window and the add-ons are initialized.
+
+        Quit and raise TimeoutException if the browser is not ready in time.
+        """
+        addon_id = cm.NO_SCRIPT_ADDON_ID if wait_for_noscript else None
+        try:
+            wait_for_browser_ready(self, timeout, addon_id)
+        except TimeoutException:
+            self.quit()
+            raise
 
     def install_extensions(self, extensions, install_noscript):
         """Install the given extensions to the profile we are launching."""
@@ -190,10 +442,12 @@ class TorBrowserDriver(FirefoxDriver):
         else:
             # fall back to default tor data dir in TBB
             self.tor_data_dir = join(tbb_path, cm.DEFAULT_TOR_DATA_PATH)
-        # TB can't find bundled "fonts" if we don't switch to tbb_browser_dir
-        chdir(self.tbb_browser_dir)
 
-    def load_url(self, url, wait_on_page=0, wait_for_page_body=False):
+    def load_url(self, url, wait_on_page=0, wait_for_page_body=False,
+                 wait_for_selector=None, wait_for_js=None,
+                 network_idle_ms=None,
+                 completion_timeout=cm.PAGE_COMPLETION_TIMEOUT,
+                 visit_id=None):
         """Load a URL and wait before returning.
 
         If you query/manipulate DOM or execute a script immediately
@@ -204,12 +458,95 @@ class TorBrowserDriver(FirefoxDriver):
         To prevent this, set wait_for_page_body to True, and driver
         will wait for the page body to become available before it returns.
 
+        Instead of sleeping for a fixed `wait_on_page` seconds, you can wait
+        until the page is complete by one or more of these criteria:
+            wait_for_selector: an element matching the CSS selector exists
+            wait_for_js: the JavaScript snippet returns a truthy value,
+                e.g. "return window.appReady === true"
+            network_idle_ms: no resource finished loading for this many ms
+        All waits, including wait_for_page_body, share a deadline of
+        `completion_timeout` seconds from the start of the load, after which
+        a TimeoutException is raised. With the "none" page load
+        strategy, we first wait until the new document replaces the
+        previous one, so that the criteria are not checked on the latter.
+
+        With record_tor_events, the tor events are tagged with `visit_id`,
+        which defaults to the number of URLs loaded by this driver.
         """
-        self.get(url)
-        if wait_for_page_body:
-            # if the page can't be loaded this will raise a TimeoutException
-            self.find_element_by("body", find_by=By.TAG_NAME)
-        sleep(wait_on_page)
+        wait_for_document = self.page_load_strategy == "none" and any(
+            (wait_for_page_body, wait_for_selector, wait_for_js,
+             network_idle_ms))
+        with self.recording_visit(visit_id):
+            if wait_for_document:
+                time_origin = self.document_time_origin()
+            deadline = monotonic() + completion_timeout
+
+            def time_left():
+                return max(0, deadline - monotonic())
+
+            self.get(url)
+            if wait_for_document:
+                self.wait_for_new_document(time_origin, time_left())
+            if wait_for_page_body:
+                # if the page can't be loaded this raises a TimeoutException
+                self.find_element_by("body", timeout=time_left(),
+                                     find_by=By.TAG_NAME)
+            if wait_for_selector:
+                self.find_element_by(wait_for_selector, timeout=time_left())
+            if wait_for_js:
+                WebDriverWait(self, time_left(), poll_frequency=0.1).until(
+                    lambda driver: driver.execute_script(wait_for_js),
+                    "Page predicate is not true after %ss"
+                    % completion_timeout)
+            if network_idle_ms:
+                self.wait_for_network_idle(network_idle_ms, time_left())
+            sleep(wait_on_page)
+
+    def document_time_origin(self):
+        """Return the time origin of the current document, or None if it
+        can't be read, e.g. while a navigation is in progress."""
+        try:
+            return self.execute_script(DOCUMENT_TIME_ORIGIN_SCRIPT)
+        except WebDriverException:
+            return None
+
+    def wait_for_new_document(self, old_time_origin, timeout):
+        """Wait until a document other than the one with old_time_origin
+        is committed."""
+        WebDriverWait(self, timeout, poll_frequency=0.1).until(
+            lambda driver: driver.document_time_origin() not in (
+                None, old_time_origin),
+            "New document is not loaded after %ss" % timeout)
+
+    @contextmanager
+    def recording_visit(self, visit_id=None):
+        """Tag the tor events of the enclosed block with the visit ID and
+        emit the visit record at the end, even if the visit fails."""
+        self.n_visits += 1
+        if self.tor_event_recorder is None:
+            yield
+            return
+        if visit_id is None:
+            visit_id = self.n_visits
+        self.tor_event_recorder.begin_visit(visit_id)
+        try:
+            yield
+        finally:
+            self.last_visit_record = self.tor_event_recorder.end_visit()
+            if self.visit_record_callback:
+                self.visit_record_callback(self.last_visit_record)
+
+    def wait_for_network_idle(self, idle_ms, timeout):
+        """Wait until no resource finished loading for `idle_ms`.
+
+        We use the Resource Timing entries of the page, which only include
+        completed requests. Idle time is measured since the end of the last
+        response, or the end of the document response if there's none.
+        """
+        WebDriverWait(self, timeout, poll_frequency=0.1).until(
+            lambda driver: driver.execute_script(
+                NETWORK_IDLE_TIME_SCRIPT) >= idle_ms,
+            "Network is not idle for %sms after %ss" % (idle_ms, timeout))
 
     def find_element_by(self, selector, timeout=30,
                         find_by=By.CSS_SELECTOR):
@@ -217,96 +554,76 @@ class TorBrowserDriver(FirefoxDriver):
         return WebDriverWait(self, timeout).until(
             EC.presence_of_element_located((find_by, selector)))
 
-    def add_ports_to_fx_banned_ports(self, socks_port, control_port):
-        """By default, ports 9050,9051,9150,9151 are banned in TB.
-
-        If we use a tor process running on a custom SOCKS port, we add SOCKS
-        and control ports to the following prefs:
-            network.security.ports.banned
-            extensions.torbutton.banned_ports
-        """
-        if socks_port in cm.KNOWN_SOCKS_PORTS:
-            return
-        tb_prefs = self.options.preferences
-        set_pref = self.options.set_preference
-
-        for port_ban_pref in cm.PORT_BAN_PREFS:
-            banned_ports = tb_prefs.get(port_ban_pref, DEFAULT_BANNED_PORTS)
-            set_pref(port_ban_pref, "%s,%s,%s" %
-                     (banned_ports, socks_port, control_port))
-
-    def set_tb_prefs_for_using_system_tor(self, control_port):
-        """Set the preferences suggested by start-tor-browser script
-        to run TB with system-installed Tor.
+    def init_prefs(self, pref_dict, default_bridge_type):
+        """Set the launch prefs on the options.
 
-        We set these prefs for running with Tor started with Stem as well.
+        The prefs are computed once per process for the same arguments and
+        shared by the drivers, see TBLaunchConfig.
         """
-        set_pref = self.options.set_preference
-        # Prevent Tor Browser running its own Tor process
-        set_pref('extensions.torlauncher.start_tor', False)
-        # TODO: investigate whether these prefs are up to date or not
-        set_pref('extensions.torbutton.block_disk', False)
-        set_pref('extensions.torbutton.custom.socks_host', '127.0.0.1')
-        set_pref('extensions.torbutton.custom.socks_port', self.socks_port)
-        set_pref('extensions.torbutton.inserted_button', True)
-        set_pref('extensions.torbutton.launch_warning', False)
-        set_pref('privacy.spoof_english', 2)
-        set_pref('extensions.torbutton.loglevel', 2)
-        set_pref('extensions.torbutton.logmethod', 0)
-        set_pref('extensions.torbutton.settings_method', 'custom')
-        set_pref('extensions.torbutton.use_privoxy', False)
-        set_pref('extensions.torlauncher.control_port', control_port)
-        set_pref('extensions.torlauncher.loglevel', 2)
-        set_pref('extensions.torlauncher.logmethod', 0)
-        set_pref('extensions.torlauncher.prompt_at_startup', False)
-        # disable XPI signature checking
-        set_pref('xpinstall.signatures.required', False)
-        set_pref('xpinstall.whitelist.required', False)
-
-    def init_prefs(self, pref_dict, default_bridge_type):
-        self.add_ports_to_fx_banned_ports(self.socks_port, self.control_port)
-        set_pref = self.options.set_preference
-        set_pref('browser.startup.page', "0")
-        set_pref('torbrowser.settings.quickstart.enabled', True)
-        set_pref('browser.startup.homepage', 'about:newtab')
-        set_pref('extensions.torlauncher.prompt_at_startup', 0)
-        # load strategy normal is equivalent to "onload"
-        set_pref('webdriver.load.strategy', 'normal')
-        # disable auto-update
-        set_pref('app.update.enabled', False)
-        set_pref('extensions.torbutton.versioncheck_enabled', False)
-        if default_bridge_type:
-            # to use a non-default bridge, overwrite the relevant pref, e.g.:
-            # extensions.torlauncher.default_bridge.meek-azure.1 = meek 0.0....
-            set_pref('extensions.torlauncher.default_bridge_type',
-                     default_bridge_type)
-
-        set_pref('extensions.torbutton.prompted_language', True)
-        # https://gitlab.torproject.org/tpo/applications/tor-browser/-/issues/41378
-        set_pref('intl.language_notification.shown', True)
-        # Configure Firefox to use Tor SOCKS proxy
-        set_pref('network.proxy.socks_port', self.socks_port)
-        set_pref('extensions.torbutton.socks_port', self.socks_port)
-        set_pref('extensions.torlauncher.control_port', self.control_port)
-        self.set_tb_prefs_for_using_system_tor(self.control_port)
-        # pref_dict overwrites above preferences
-        for pref_name, pref_val in pref_dict.items():
-            set_pref(pref_name, pref_val)
-        # self.profile.update_preferences()
+        self.launch_config = TBLaunchConfig.get(
+            self.browser_socks_port, self.control_port, default_bridge_type,
+            pref_dict, self.security_level, self.page_load_strategy,
+            self.options.preferences)
+        self.options.preferences.update(self.launch_config.prefs)
 
     def export_env_vars(self):
-        """Setup LD_LIBRARY_PATH and HOME environment variables.
+        """Setup LD_LIBRARY_PATH and HOME environment variables for the
+        geckodriver and browser processes in self.tbb_env.
 
-        We follow start-tor-browser script.
+        We follow start-tor-browser script. The environment of this
+        process is left untouched.
         """
+        tbb_env = dict(environ)
         tor_binary_dir = join(self.tbb_path, cm.DEFAULT_TOR_BINARY_DIR)
-        environ["LD_LIBRARY_PATH"] = tor_binary_dir
-        environ["FONTCONFIG_PATH"] = join(self.tbb_path,
+        tbb_env["LD_LIBRARY_PATH"] = tor_binary_dir
+        tbb_env["FONTCONFIG_PATH"] = join(self.tbb_path,
                                           cm.DEFAULT_FONTCONFIG_PATH)
-        environ["FONTCONFIG_FILE"] = cm.FONTCONFIG_FILE
-        environ["HOME"] = self.tbb_browser_dir
+        tbb_env["FONTCONFIG_FILE"] = cm.FONTCONFIG_FILE
+        tbb_env["HOME"] = self.tbb_browser_dir
         # Add "TBB_DIR/Browser" to the PATH, see issue #10.
-        prepend_to_env_var("PATH", self.tbb_browser_dir)
+        prepend_to_env_var("PATH", self.tbb_browser_dir, tbb_env)
+        if self.ram_dir:
+            # geckodriver unpacks the profile to a temp dir
+            tbb_env["TMPDIR"] = self.ram_dir
+        self.tbb_env = tbb_env
+
+    def close_extra_windows(self):
+        """Close all windows but the first one and switch to it."""
+        handles = self.window_handles
+        for handle in handles[1:]:
+            self.switch_to.window(handle)
+            self.close()
+        self.switch_to.window(handles[0])
+
+    def clear_browsing_data(self):
+        """Clear cookies, storage, caches and history in the browser.
+
+        Return True if everything is cleared and no cookies are left.
+        """
+        try:
+            self.set_context(self.CONTEXT_CHROME)
+            result = self.execute_async_script(CLEAR_BROWSING_DATA_SCRIPT)
+        finally:
+            self.set_context(self.CONTEXT_CONTENT)
+        return result["failedFlags"] == 0 and result["cookies"] == 0
+
+    def new_identity(self, newnym=True, control_password=None):
+        """Reset the browser state so that the next visit can't be linked
+        to the previous ones, without restarting the browser.
+
+        Close extra windows, go to about:blank, clear the browsing data
+        and, if `newnym` is True, send NEWNYM to tor over the control port
+        (requires Stem). control_password defaults to the one the driver
+        was launched with. Return True if the browsing data is cleared.
+        """
+        self.close_extra_windows()
+        self.get(cm.ABOUT_BLANK_URL)
+        is_cleared = self.clear_browsing_data()
+        if newnym:
+            if control_password is None:
+                control_password = self.control_password
+            send_newnym(self.control_port, control_password)
+        return is_cleared
 
     def get_tb_binary(self, logfile=None):
         """Return FirefoxBinary pointing to the TBB's firefox binary."""
@@ -314,10 +631,20 @@ class TorBrowserDriver(FirefoxDriver):
         return TBBinary(firefox_path=self.tbb_fx_binary_path,
                         log_file=tbb_logfile)
 
+    @property
+    def connection_error(self):
+        """Return the error type if the current page is an error page.
+
+        The error type comes from the `e` parameter of the about:neterror or
+        about:certerror page, e.g. netTimeout, dnsNotFound,
+        proxyConnectFailure or nssFailure2. Return None for other pages.
+        """
+        return self.execute_script(CONNECTION_ERROR_SCRIPT)
+
     @property
     def is_connection_error_page(self):
         """Check if we get a connection error, i.e. 'Problem loading page'."""
-        return "ENTITY connectionFailure.title" in self.page_source
+        return self.connection_error is not None
 
     def clean_up_profile_dirs(self):
         """Remove temporary profile directories.
@@ -328,11 +655,138 @@ class TorBrowserDriver(FirefoxDriver):
             # i.e. stateful mode
             return
 
-        if self.temp_profile_dir and isdir(self.temp_profile_dir):
-            shutil.rmtree(self.temp_profile_dir)
+        temp_profile_dir = getattr(self, "temp_profile_dir", None)
+        if temp_profile_dir and isdir(temp_profile_dir):
+            shutil.rmtree(temp_profile_dir)
+
+    def kill(self):
+        """Kill geckodriver and the browser without waiting for them to quit.
 
-    def quit(self):
-        """Quit the driver. Clean up if the parent's quit fails."""
+        This is useful when the browser is stuck and quit() would block.
+        Without psutil, only geckodriver and the browser's main process
+        are killed, the content processes exit when the latter is gone.
+        """
+        self.is_running = False
+        service_process = getattr(getattr(self, "service", None),
+                                  "process", None)
+        browser_pid = (getattr(self, "caps", None) or {}).get(
+            "moz:processID")
+        # while geckodriver runs, its browser child's PID can't be reused
+        if browser_pid and service_process and \
+                service_process.poll() is None:
+            kill_process_tree(browser_pid)
+        if service_process:
+            kill_process_tree(service_process.pid)
+        try:
+            self.clean_up_profile_dirs()
+        except Exception as e:
+            print("[tbselenium] Exception while cleaning up: %s" % e)
+        self.stop_recorders()
+        self.remove_ram_dir()
+        self.release_ports()
+        unregister_driver(self)
+
+    def resource_usage(self):
+        """Sample the memory and CPU usage of geckodriver and the browser
+        processes it started. Requires psutil.
+
+        Return a dict with the number of processes, their total `rss` in
+        bytes and `cpu_time` in seconds (see get_process_tree_usage), and
+        `cpu_percent` since the previous call (None on the first call).
+        Return None if the browser is not running.
+        """
+        service_process = getattr(getattr(self, "service", None),
+                                  "process", None)
+        if service_process is None:
+            return None
+        usage = get_process_tree_usage(service_process.pid)
+        if usage is None:
+            return None
+        now = monotonic()
+        usage["cpu_percent"] = None
+        if self.last_usage_sample:
+            last_time, last_usage = self.last_usage_sample
+            # CPU time of the processes that exited since is not counted
+            cpu_time = max(0, usage["cpu_time"] - last_usage["cpu_time"])
+            usage["cpu_percent"] = 100 * cpu_time / max(now - last_time,
+                                                         1e-6)
+        self.last_usage_sample = (now, usage)
+        return usage
+
+    def remove_ram_dir(self):
+        """Remove the driver's directory under ram_dir."""
+        ram_dir = getattr(self, "ram_dir", None)
+        if ram_dir:
+            shutil.rmtree(ram_dir, ignore_errors=True)
+            self.ram_dir = None
+
+    def lease_port(self):
+        """Lease a free port that is released when the driver quits."""
+        port = lease_port()
+        self.leased_ports.append(port)
+        return port
+
+    def release_ports(self):
+        """Release the ports leased for this driver."""
+        for port in getattr(self, "leased_ports", []):
+            release_port(port)
+        self.leased_ports = []
+
+    @contextmanager
+    def traffic_trace(self, trace_path):
+        """Record the traffic of the enclosed block to `trace_path`.
+
+        Requires record_traffic=True. Each line of the trace is a JSON
+        record, see SocksRecorder:
+
+            with driver.traffic_trace("visit-1.jsonl"):
+                driver.load_url(url)
+        """
+        if self.socks_recorder is None:
+            raise TBDriverConfigError("Launch the driver with"
+                                      " record_traffic=True to record"
+                                      " traffic traces")
+        self.socks_recorder.start_trace(trace_path)
+        try:
+            yield
+        finally:
+            self.socks_recorder.stop_trace()
+
+    def stop_recorders(self):
+        """Stop recording the traffic and tor events."""
+        for recorder in (getattr(self, "socks_recorder", None),
+                         getattr(self, "tor_event_recorder", None)):
+            if recorder:
+                recorder.stop()
+
+    def deadline(self, timeout):
+        """Kill the browser if the enclosed block takes longer than
+        `timeout` seconds, and raise TimeExceededError.
+
+            with driver.deadline(60):
+                driver.load_url(url)
+        """
+        return Watchdog(self, timeout)
+
+    def quit(self, timeout=None, block=True):
+        """Quit the driver. Clean up if the parent's quit fails.
+
+        If the browser doesn't quit within `timeout` seconds, kill it and
+        raise TimeExceededError.
+
+        With block=False, return right away and quit the driver on a
+        background thread, see teardown.quit_in_background. The browser
+        is killed if it doesn't quit within `timeout` (default:
+        cm.QUIT_TIMEOUT) seconds. Return a Future that is done when the
+        teardown is over.
+        """
+        if not block:
+            self.is_running = False
+            return quit_in_background(
+                self, cm.QUIT_TIMEOUT if timeout is None else timeout)
+        if timeout is not None:
+            with self.deadline(timeout):
+                return self.quit()
         self.is_running = False
         try:
             super(TorBrowserDriver, self).quit()
@@ -345,6 +799,11 @@ class TorBrowserDriver(FirefoxDriver):
                     self.clean_up_profile_dirs()
             except Exception as e:
                 print("[tbselenium] Exception while quitting: %s" % e)
+        finally:
+            self.stop_recorders()
+            self.remove_ram_dir()
+            self.release_ports()
+            unregister_driver(self)
 
     def __enter__(self):
         return self
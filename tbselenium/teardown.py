@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import tbselenium.common as cm
+from tbselenium.exceptions import TimeExceededError
+
+DEFAULT_MAX_WORKERS = 4
+
+_executor = None
+_pending = set()  # teardowns that didn't finish yet
+_lock = threading.Lock()
+
+
+def get_teardown_executor():
+    """Return the executor that runs the background teardowns."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=DEFAULT_MAX_WORKERS,
+                thread_name_prefix="tbselenium-teardown")
+        return _executor
+
+
+def teardown(driver, timeout):
+    """Quit the driver, kill it if it doesn't quit within `timeout`."""
+    try:
+        driver.quit(timeout=timeout)
+    except TimeExceededError:
+        print("[tbselenium] Browser didn't quit in %ss, killed it" % timeout)
+    except Exception as e:
+        print("[tbselenium] Exception while quitting: %s" % e)
+
+
+def quit_in_background(driver, timeout=cm.QUIT_TIMEOUT):
+    """Quit the driver on the teardown executor and return a Future.
+
+    The executor's threads are joined at exit, so the browsers are gone
+    by the time the interpreter exits.
+    """
+    future = get_teardown_executor().submit(teardown, driver, timeout)
+    with _lock:
+        _pending.add(future)
+    future.add_done_callback(forget_teardown)
+    return future
+
+
+def forget_teardown(future):
+    with _lock:
+        _pending.discard(future)
+
+
+def wait_for_teardowns(timeout=None):
+    """Wait for the background teardowns, return True if all are done."""
+    with _lock:
+        pending = set(_pending)
+    _, not_done = wait(pending, timeout=timeout)
+    return not not_done
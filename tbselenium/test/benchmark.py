@@ -0,0 +1,359 @@
+"""Offline benchmarks for TorBrowserDriver.
+
+The browser loads pages from a local HTTP server through a local SOCKS
+server, so neither tor nor a network connection is needed. The pages are
+the HTML files in test_data and a generated corpus. Use run_benchmarks.py
+to run them:
+
+    python run_benchmarks.py /path/to/tor-browser/ --output results.json
+
+and to compare a later run with the stored results:
+
+    python run_benchmarks.py /path/to/tor-browser/ --baseline results.json
+
+To see what a pref preset saves with 4 browsers running at once:
+
+    python run_benchmarks.py /path/to/tor-browser/ --concurrency 4 \
+        --output default.json
+    python run_benchmarks.py /path/to/tor-browser/ --concurrency 4 \
+        --preset lean --baseline default.json
+"""
+import json
+import random
+import shutil
+import platform
+import tempfile
+import threading
+import statistics
+from glob import glob
+from os import makedirs
+from os.path import basename, join
+from time import perf_counter, time
+from functools import partial
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import tbselenium.common as cm
+from tbselenium.tbdriver import TorBrowserDriver
+from tbselenium.ports import lease_port, release_port
+from tbselenium.test.socks_server import LocalSocksServer
+
+DEFAULT_N_RUNS = 3
+DEFAULT_CONCURRENCY = 1
+DEFAULT_CORPUS_SIZE = 20
+# a median this much slower than the baseline counts as a regression
+DEFAULT_TOLERANCE = 0.2
+CORPUS_SEED = 1
+# metrics not listed here are timings, in seconds
+METRIC_UNITS = {"browser_rss_mb": "MB"}
+# generated pages have an element with this id
+CONTENT_SELECTOR = "#content"
+WORDS = ("tor", "onion", "relay", "circuit", "guard", "exit", "bridge",
+         "consensus", "directory", "hidden", "service", "stream")
+
+
+class QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class LocalHTTPServer(ThreadingHTTPServer):
+    """Serve the files in `directory` on localhost."""
+    daemon_threads = True
+
+    def __init__(self, directory):
+        ThreadingHTTPServer.__init__(
+            self, ("127.0.0.1", 0),
+            partial(QuietHTTPRequestHandler, directory=directory))
+        self.port = self.server_address[1]
+
+    def url(self, path):
+        return "http://127.0.0.1:%d/%s" % (self.port, path)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+def generate_page(rnd, page_no):
+    """Return an HTML page with a random number of paragraphs, list items
+    and inline images."""
+    def text(n_words):
+        return " ".join(rnd.choice(WORDS) for _ in range(n_words))
+
+    parts = ["<!DOCTYPE html>", "<html><head><meta charset='utf-8'>",
+             "<title>Corpus page %d</title>" % page_no,
+             "<style>p {font-family: serif;} li {color: #333;}</style>",
+             "</head><body><div id='content'>"]
+    for _ in range(rnd.randint(5, 200)):
+        parts.append("<p>%s</p>" % text(rnd.randint(10, 100)))
+    parts.append("<ul>")
+    parts.extend("<li>%s</li>" % text(5)
+                 for _ in range(rnd.randint(0, 100)))
+    parts.append("</ul>")
+    for _ in range(rnd.randint(0, 10)):
+        size = rnd.randint(16, 256)
+        parts.append(
+            "<img width='%d' height='%d' src=\"data:image/svg+xml,"
+            "<svg xmlns='http://www.w3.org/2000/svg' width='%d' height='%d'>"
+            "<circle cx='50%%' cy='50%%' r='40%%' fill='purple'/></svg>\">"
+            % (size, size, size, size))
+    parts.append("</div></body></html>")
+    return "\n".join(parts)
+
+
+def generate_corpus(corpus_dir, n_pages, seed=CORPUS_SEED):
+    """Write `n_pages` generated pages to corpus_dir and return their
+    file names. The same seed gives the same pages."""
+    makedirs(corpus_dir, exist_ok=True)
+    rnd = random.Random(seed)
+    file_names = []
+    for page_no in range(n_pages):
+        file_name = "page-%04d.html" % page_no
+        with open(join(corpus_dir, file_name), "w") as f:
+            f.write(generate_page(rnd, page_no))
+        file_names.append(file_name)
+    return file_names
+
+
+def prepare_pages(root_dir, corpus_size):
+    """Put the test_data pages and the corpus under root_dir and return
+    their paths relative to root_dir."""
+    pages = []
+    for page in sorted(glob(join(cm.TEST_DATA_DIR, "*.html"))):
+        shutil.copy(page, root_dir)
+        pages.append(basename(page))
+    corpus = generate_corpus(join(root_dir, "corpus"), corpus_size)
+    pages.extend("corpus/" + page for page in corpus)
+    return pages
+
+
+def summarize(samples):
+    """Return the summary statistics of a list of samples."""
+    ordered = sorted(samples)
+    return {
+        "n": len(ordered),
+        "median": statistics.median(ordered),
+        "mean": statistics.mean(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "p90": ordered[min(len(ordered) - 1, int(0.9 * len(ordered)))],
+        }
+
+
+class BenchmarkRunner(object):
+    """Time the driver's startup, page loads, element lookups, screenshots
+    and quit.
+
+    In each run, `concurrency` browsers visit all pages at the same time.
+    The memory and CPU time of each browser's processes are sampled after
+    the visits (requires psutil). `driver_kwargs` are passed to
+    TorBrowserDriver, e.g. to benchmark a pref preset.
+    """
+    def __init__(self, tbb_path, n_runs=DEFAULT_N_RUNS,
+                 corpus_size=DEFAULT_CORPUS_SIZE, headless=True,
+                 concurrency=DEFAULT_CONCURRENCY, driver_kwargs={}):
+        self.tbb_path = tbb_path
+        self.n_runs = n_runs
+        self.corpus_size = corpus_size
+        self.headless = headless
+        self.concurrency = concurrency
+        self.driver_kwargs = driver_kwargs
+        self.samples = {}
+        self._lock = threading.Lock()
+
+    def add_sample(self, metric, value):
+        with self._lock:
+            self.samples.setdefault(metric, []).append(value)
+
+    def launch(self, socks_port, control_port, profile_cache_dir):
+        t_start = perf_counter()
+        driver = TorBrowserDriver(
+            self.tbb_path, tor_cfg=cm.USE_RUNNING_TOR,
+            socks_port=socks_port, control_port=control_port,
+            profile_cache_dir=profile_cache_dir, headless=self.headless,
+            **self.driver_kwargs)
+        return driver, perf_counter() - t_start
+
+    def timed_quit(self, driver):
+        t_start = perf_counter()
+        driver.quit()
+        self.add_sample("quit", perf_counter() - t_start)
+
+    def visit(self, driver, url, has_content):
+        t_start = perf_counter()
+        driver.load_url(url)
+        self.add_sample("load_url", perf_counter() - t_start)
+        if has_content:
+            t_start = perf_counter()
+            driver.find_element_by(CONTENT_SELECTOR)
+            self.add_sample("find_element_by", perf_counter() - t_start)
+        t_start = perf_counter()
+        driver.get_screenshot_as_png()
+        self.add_sample("screenshot", perf_counter() - t_start)
+
+    def run_browser(self, socks_port, control_port, profile_cache_dir,
+                    http_server, pages):
+        """Launch a browser with a warm profile cache and visit the pages."""
+        driver, duration = self.launch(socks_port, control_port,
+                                       profile_cache_dir)
+        self.add_sample("warm_startup", duration)
+        for phase, phase_duration in driver.startup_timings.items():
+            self.add_sample("startup." + phase, phase_duration)
+        try:
+            for page in pages:
+                self.visit(driver, http_server.url(page),
+                           page.startswith("corpus/"))
+            try:
+                usage = driver.resource_usage()
+            except ImportError:  # no psutil
+                usage = None
+            if usage is None:
+                print("[tbselenium] Cannot sample the browser's resource "
+                      "usage")
+            else:
+                self.add_sample("browser_rss_mb", usage["rss"] / 2 ** 20)
+                self.add_sample("browser_cpu_time", usage["cpu_time"])
+        finally:
+            self.timed_quit(driver)
+
+    def run_once(self, socks_port, control_port, http_server, pages):
+        # the profile cache is empty for the cold start, and reused by the
+        # warm starts
+        profile_cache_dir = tempfile.mkdtemp()
+        try:
+            driver, duration = self.launch(socks_port, control_port,
+                                           profile_cache_dir)
+            self.add_sample("cold_startup", duration)
+            self.timed_quit(driver)
+            with ThreadPoolExecutor(self.concurrency) as executor:
+                futures = [executor.submit(
+                    self.run_browser, socks_port, control_port,
+                    profile_cache_dir, http_server, pages)
+                    for _ in range(self.concurrency)]
+            for future in futures:
+                future.result()  # raise if a browser failed
+        finally:
+            shutil.rmtree(profile_cache_dir, ignore_errors=True)
+
+    def run(self):
+        """Run the benchmarks and return the results."""
+        root_dir = tempfile.mkdtemp()
+        # the browser doesn't connect to the control port, we only need a
+        # port that isn't used by anything else
+        control_port = lease_port()
+        try:
+            pages = prepare_pages(root_dir, self.corpus_size)
+            with LocalHTTPServer(root_dir) as http_server, \
+                    LocalSocksServer() as socks_server:
+                socks_server.start()
+                for _ in range(self.n_runs):
+                    self.run_once(socks_server.port, control_port,
+                                  http_server, pages)
+        finally:
+            release_port(control_port)
+            shutil.rmtree(root_dir, ignore_errors=True)
+        return self.results()
+
+    def results(self):
+        return {
+            "timestamp": time(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "n_runs": self.n_runs,
+            "corpus_size": self.corpus_size,
+            "concurrency": self.concurrency,
+            "driver_kwargs": self.driver_kwargs,
+            "metrics": {metric: summarize(samples)
+                        for metric, samples in sorted(self.samples.items())}
+            }
+
+
+def compare_to_baseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Return the metrics whose median is slower than the baseline median
+    by more than `tolerance`, as (metric, baseline, current) tuples."""
+    regressions = []
+    for metric, baseline_stats in sorted(baseline["metrics"].items()):
+        current_stats = results["metrics"].get(metric)
+        if current_stats is None:
+            continue
+        if current_stats["median"] > \
+                baseline_stats["median"] * (1 + tolerance):
+            regressions.append((metric, baseline_stats["median"],
+                                current_stats["median"]))
+    return regressions
+
+
+def get_metric_unit(metric):
+    """Return the unit of the metric's samples."""
+    return METRIC_UNITS.get(metric, "s")
+
+
+def format_metric(metric):
+    return "%s (%s)" % (metric, get_metric_unit(metric))
+
+
+def print_results(results):
+    print("%-40s %10s %10s %10s" % ("metric", "median", "p90", "max"))
+    for metric, stats in results["metrics"].items():
+        print("%-40s %10.4f %10.4f %10.4f" % (
+            format_metric(metric), stats["median"], stats["p90"],
+            stats["max"]))
+
+
+def print_comparison(results, baseline):
+    print("%-40s %10s %10s %8s" % ("metric", "baseline", "median",
+                                   "change"))
+    for metric, stats in results["metrics"].items():
+        baseline_stats = baseline["metrics"].get(metric)
+        if not baseline_stats or not baseline_stats["median"]:
+            continue
+        change = stats["median"] / baseline_stats["median"] - 1
+        print("%-40s %10.4f %10.4f %+7.1f%%" % (
+            format_metric(metric), baseline_stats["median"],
+            stats["median"], 100 * change))
+
+
+def main(args=None):
+    parser = ArgumentParser(description="Run the offline benchmarks")
+    parser.add_argument("tbb_path")
+    parser.add_argument("--runs", type=int, default=DEFAULT_N_RUNS)
+    parser.add_argument("--corpus-size", type=int,
+                        default=DEFAULT_CORPUS_SIZE)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline",
+                        help="compare with the results in this file")
+    parser.add_argument("--tolerance", type=float,
+                        default=DEFAULT_TOLERANCE)
+    parser.add_argument("--no-headless", action="store_true")
+    parser.add_argument("--concurrency", type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help="number of browsers that run at once")
+    parser.add_argument("--preset", help="pref preset, e.g. lean")
+    args = parser.parse_args(args)
+
+    driver_kwargs = {"preset": args.preset} if args.preset else {}
+    runner = BenchmarkRunner(args.tbb_path, args.runs, args.corpus_size,
+                             headless=not args.no_headless,
+                             concurrency=args.concurrency,
+                             driver_kwargs=driver_kwargs)
+    results = runner.run()
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print_comparison(results, baseline)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        for metric, baseline_median, median in regressions:
+            unit = get_metric_unit(metric)
+            print("[tbselenium] Regression in %s: %.4f %s (baseline %.4f %s)"
+                  % (metric, median, unit, baseline_median, unit))
+        return 1 if regressions else 0
+    return 0
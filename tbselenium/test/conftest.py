@@ -11,14 +11,16 @@ test_conf = {}
 
 def launch_tor():
     # TODO: Consider using system tor (when available) to speed tests up
+    # Reuse the consensus from the previous test runs to bootstrap faster
     tor_process = None
     temp_data_dir = tempfile.mkdtemp()
     torrc = {'ControlPort': str(cm.STEM_CONTROL_PORT),
              'SOCKSPort': str(cm.STEM_SOCKS_PORT),
              'DataDirectory': temp_data_dir}
     if not is_busy(cm.STEM_SOCKS_PORT):
-        tor_process = launch_tbb_tor_with_stem_fixture(tbb_path=TBB_PATH,
-                                                       torrc=torrc)
+        tor_process = launch_tbb_tor_with_stem_fixture(
+            tbb_path=TBB_PATH, torrc=torrc,
+            data_dir_seed=cm.DEFAULT_TOR_DATA_SEED_DIR)
     return (temp_data_dir, tor_process)
 
 
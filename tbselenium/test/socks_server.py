@@ -0,0 +1,109 @@
+import socket
+import select
+import struct
+import threading
+import socketserver
+
+SOCKS_VERSION = 5
+NO_AUTH = 0
+CMD_CONNECT = 1
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+REPLY_SUCCEEDED = 0
+REPLY_FAILURE = 1
+REPLY_CMD_NOT_SUPPORTED = 7
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the client")
+        data += chunk
+    return data
+
+
+class SocksHandler(socketserver.BaseRequestHandler):
+    """Serve a SOCKS5 CONNECT request without authentication."""
+
+    def handle(self):
+        client = self.request
+        try:
+            target = self.negotiate(client)
+        except (ConnectionError, OSError):
+            return
+        if target is None:
+            return
+        try:
+            upstream = socket.create_connection(target, timeout=10)
+        except OSError:
+            self.reply(client, REPLY_FAILURE)
+            return
+        with upstream:
+            self.reply(client, REPLY_SUCCEEDED)
+            self.pipe(client, upstream)
+
+    def negotiate(self, client):
+        """Return the (host, port) that the client wants to connect to."""
+        _, n_methods = recv_exactly(client, 2)
+        recv_exactly(client, n_methods)
+        client.sendall(bytes([SOCKS_VERSION, NO_AUTH]))
+        _, cmd, _, atyp = recv_exactly(client, 4)
+        if atyp == ATYP_IPV4:
+            host = socket.inet_ntoa(recv_exactly(client, 4))
+        elif atyp == ATYP_DOMAIN:
+            length = recv_exactly(client, 1)[0]
+            host = recv_exactly(client, length).decode()
+        elif atyp == ATYP_IPV6:
+            host = socket.inet_ntop(socket.AF_INET6, recv_exactly(client, 16))
+        else:
+            raise ConnectionError("Unknown address type: %s" % atyp)
+        port, = struct.unpack("!H", recv_exactly(client, 2))
+        if cmd != CMD_CONNECT:
+            self.reply(client, REPLY_CMD_NOT_SUPPORTED)
+            return None
+        return host, port
+
+    def reply(self, client, status):
+        client.sendall(bytes([SOCKS_VERSION, status, 0, ATYP_IPV4]) +
+                       socket.inet_aton("0.0.0.0") + struct.pack("!H", 0))
+
+    def pipe(self, client, upstream):
+        socks = [client, upstream]
+        while True:
+            readable, _, _ = select.select(socks, [], [])
+            for sock in readable:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                (upstream if sock is client else client).sendall(data)
+
+
+class LocalSocksServer(socketserver.ThreadingTCPServer):
+    """Minimal SOCKS5 proxy on localhost that stands in for tor's SOCKS
+    port, so that we can test without connecting to the Tor network.
+
+        with LocalSocksServer() as socks_server:
+            socks_server.start()
+            print(socks_server.port)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        socketserver.ThreadingTCPServer.__init__(
+            self, ("127.0.0.1", port), SocksHandler)
+        self.port = self.server_address[1]
+        self.is_serving = False
+
+    def start(self):
+        self.is_serving = True
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+
+    def __exit__(self, *args):
+        if self.is_serving:
+            self.shutdown()
+        self.server_close()
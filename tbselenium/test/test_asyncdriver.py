@@ -0,0 +1,94 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import patch, ANY
+from time import sleep
+from tbselenium.test import TBB_PATH
+from tbselenium.test.fixtures import TBDriverFixture
+from tbselenium.asyncdriver import AsyncTorBrowser
+from tbselenium.common import LOCAL_JS_TEST_URL
+
+
+class SlowLaunchDriver(object):
+    """Records how many instances are launching at once."""
+    lock = threading.Lock()
+    launching = 0
+    max_launching = 0
+
+    def __init__(self, tbb_path):
+        cls = SlowLaunchDriver
+        with cls.lock:
+            cls.launching += 1
+            cls.max_launching = max(cls.max_launching, cls.launching)
+        sleep(0.1)
+        with cls.lock:
+            cls.launching -= 1
+
+    def quit(self, block=True):
+        pass
+
+
+class AsyncTorBrowserTest(unittest.TestCase):
+
+    def test_launch_should_acquire_semaphore(self):
+        async def main():
+            semaphore = asyncio.Semaphore(1)
+            return await asyncio.gather(*[
+                AsyncTorBrowser.launch(TBB_PATH, semaphore=semaphore,
+                                       driver_class=SlowLaunchDriver)
+                for _ in range(3)])
+
+        browsers = asyncio.run(main())
+        self.assertEqual(len(browsers), 3)
+        self.assertEqual(SlowLaunchDriver.max_launching, 1)
+
+    def test_should_load_pages_concurrently(self):
+        async def visit(semaphore):
+            async with await AsyncTorBrowser.launch(
+                    TBB_PATH, driver_class=TBDriverFixture,
+                    semaphore=semaphore) as browser:
+                await browser.load_url(LOCAL_JS_TEST_URL)
+                element = await browser.find_element_by("#js")
+                return element.text
+
+        async def main():
+            semaphore = asyncio.Semaphore(2)
+            return await asyncio.gather(*[visit(semaphore) for _ in range(2)])
+
+        self.assertEqual(asyncio.run(main()), 2 * ["JavaScript is enabled."])
+
+    def test_should_quit_cancelled_launch_without_blocking(self):
+        async def main():
+            launch = asyncio.ensure_future(AsyncTorBrowser.launch(
+                TBB_PATH, driver_class=SlowLaunchDriver))
+            await asyncio.sleep(0.01)
+            launch.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await launch
+            # wait for the launch to finish and quit_when_done to run
+            await asyncio.sleep(0.3)
+
+        with patch.object(SlowLaunchDriver, "quit", autospec=True) as quit:
+            asyncio.run(main())
+        quit.assert_called_once_with(ANY, block=False)
+
+    def test_should_kill_browser_on_cancel(self):
+        async def main():
+            browser = await AsyncTorBrowser.launch(
+                TBB_PATH, driver_class=TBDriverFixture)
+            geckodriver_process = browser.driver.service.process
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(
+                    browser.execute_script(
+                        "const end = Date.now() + 10000;"
+                        "while (Date.now() < end) {}"),
+                    timeout=1)
+            self.assertFalse(browser.driver.is_running)
+            self.assertIsNotNone(geckodriver_process.poll())
+            await browser.quit()
+
+        asyncio.run(main())
+
+
+if __name__ == "__main__":
+    unittest.main()
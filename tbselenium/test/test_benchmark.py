@@ -0,0 +1,63 @@
+import tempfile
+import unittest
+from os.path import join
+from shutil import rmtree
+from tbselenium.test.benchmark import (
+    LocalHTTPServer, generate_corpus, prepare_pages, summarize,
+    compare_to_baseline, get_metric_unit)
+from tbselenium.test.socks_server import LocalSocksServer
+from tbselenium.test.test_trace import connect_via_socks
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_should_generate_same_corpus_for_same_seed(self):
+        pages = [generate_corpus(join(self.tmp_dir, str(i)), 5)
+                 for i in range(2)]
+        self.assertEqual(len(pages[0]), 5)
+        for page in pages[0]:
+            with open(join(self.tmp_dir, "0", page)) as f1, \
+                    open(join(self.tmp_dir, "1", page)) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_should_serve_pages_through_socks_server(self):
+        pages = prepare_pages(self.tmp_dir, 2)
+        self.assertIn("js_test.html", pages)
+        self.assertIn("corpus/page-0001.html", pages)
+        with LocalHTTPServer(self.tmp_dir) as http_server, \
+                LocalSocksServer() as socks_server:
+            socks_server.start()
+            with connect_via_socks(socks_server.port,
+                                   http_server.port) as sock:
+                sock.sendall(b"GET /corpus/page-0001.html HTTP/1.0\r\n\r\n")
+                response = b""
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    response += data
+        self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+        self.assertIn(b"<div id='content'>", response)
+
+    def test_should_detect_regressions(self):
+        baseline = {"metrics": {"load_url": summarize([1.0, 1.0, 1.0]),
+                                "quit": summarize([1.0])}}
+        results = {"metrics": {"load_url": summarize([1.1, 1.3, 1.5]),
+                               "quit": summarize([1.1])}}
+        self.assertEqual(compare_to_baseline(results, baseline, 0.2),
+                         [("load_url", 1.0, 1.3)])
+
+    def test_should_report_metric_units(self):
+        self.assertEqual(get_metric_unit("load_url"), "s")
+        self.assertEqual(get_metric_unit("browser_cpu_time"), "s")
+        self.assertEqual(get_metric_unit("browser_rss_mb"), "MB")
+
+
+if __name__ == "__main__":
+    unittest.main()
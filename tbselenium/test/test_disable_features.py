@@ -1,8 +1,10 @@
 import unittest
+from selenium.common.exceptions import JavascriptException
 from tbselenium.test.fixtures import TBDriverFixture
 from tbselenium.test import TBB_PATH
 from tbselenium.common import LOCAL_JS_TEST_URL, LOCAL_IMG_TEST_URL
-from tbselenium.utils import disable_js, get_js_status_text
+from tbselenium.utils import (disable_js, get_js_status_text, set_tbb_prefs,
+                              get_tbb_pref)
 
 
 class DisableFeaturesTest(unittest.TestCase):
@@ -38,6 +40,31 @@ class DisableFeaturesTest(unittest.TestCase):
                 "return document.querySelector('img#onion').complete === true")
             assert is_img_loaded, "Image should be loaded"
 
+    def test_set_prefs_in_batch_and_roll_back(self):
+        prefs = {"javascript.enabled": False,
+                 "permissions.default.image": 2,
+                 "tbselenium.test.string_pref": "foo"}
+        with TBDriverFixture(TBB_PATH) as driver:
+            previous = set_tbb_prefs(driver, prefs)
+            self.assertEqual(previous["javascript.enabled"], True)
+            self.assertIsNone(previous["tbselenium.test.string_pref"])
+            for name, value in prefs.items():
+                self.assertEqual(get_tbb_pref(driver, name), value)
+            set_tbb_prefs(driver, previous)
+            self.assertEqual(get_tbb_pref(driver, "javascript.enabled"), True)
+            self.assertIsNone(
+                get_tbb_pref(driver, "tbselenium.test.string_pref"))
+
+    def test_should_not_set_any_pref_if_one_fails(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            with self.assertRaises(JavascriptException):
+                # javascript.enabled is a bool pref
+                set_tbb_prefs(driver, {"permissions.default.image": 2,
+                                       "javascript.enabled": "no"})
+            self.assertEqual(get_tbb_pref(driver, "javascript.enabled"), True)
+            self.assertEqual(
+                get_tbb_pref(driver, "permissions.default.image"), 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from tbselenium.test import TBB_PATH
+from tbselenium.test.fixtures import TBDriverFixture
+from tbselenium.fleet import TorFleet
+from tbselenium.exceptions import TorFleetError
+from tbselenium.utils import is_busy
+import tbselenium.common as cm
+
+
+class TorFleetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.fleet = TorFleet(TBB_PATH, size=2)
+        cls.fleet.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fleet.stop()
+
+    def test_should_launch_instances_on_separate_ports(self):
+        socks_ports = set(tor.socks_port for tor in self.fleet.instances)
+        data_dirs = set(tor.data_dir for tor in self.fleet.instances)
+        self.assertEqual(len(socks_ports), 2)
+        self.assertEqual(len(data_dirs), 2)
+        for socks_port in socks_ports:
+            self.assertTrue(is_busy(socks_port))
+
+    def test_should_assign_least_loaded_instance(self):
+        with self.fleet.lease() as tor1:
+            with self.fleet.lease() as tor2:
+                self.assertIsNot(tor1, tor2)
+                self.assertEqual(tor1.load, 1)
+                self.assertEqual(tor2.load, 1)
+        self.assertEqual(tor1.load, 0)
+
+    def test_should_load_page_through_fleet(self):
+        with self.fleet.lease() as tor:
+            with TBDriverFixture(TBB_PATH, **tor.driver_kwargs) as driver:
+                driver.load_url_ensure(cm.CHECK_TPO_URL)
+                driver.find_element_by("h1.on")
+
+    def test_should_replace_dead_instance(self):
+        dead_tor = self.fleet.instances[0]
+        dead_tor.process.kill()
+        dead_tor.process.wait()
+        self.assertEqual(self.fleet.check_health(), [dead_tor])
+        self.assertNotIn(dead_tor, self.fleet.instances)
+        self.assertTrue(all(tor.is_healthy() for tor in self.fleet.instances))
+
+    def test_should_raise_for_invalid_size(self):
+        with self.assertRaises(TorFleetError):
+            TorFleet(TBB_PATH, size=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+import tempfile
+from os import listdir
+from os.path import join
+from shutil import rmtree
+import tbselenium.common as cm
+from tbselenium.launchconfig import (TBLaunchConfig, LEAN_PREFS,
+                                     MAX_CACHED_CONFIGS, apply_pref_preset)
+from tbselenium.utils import read_file
+
+SOCKS_PORT = 9350
+CONTROL_PORT = 9351
+
+
+class TBLaunchConfigTest(unittest.TestCase):
+
+    def test_should_share_config_for_same_args(self):
+        config = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT,
+                                    pref_dict={"foo": 1})
+        self.assertIs(config, TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT,
+                                                 pref_dict={"foo": 1}))
+        self.assertIsNot(config, TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT,
+                                                    pref_dict={"foo": 2}))
+
+    def test_should_keep_recent_configs_only(self):
+        config = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT)
+        for port_offset in range(MAX_CACHED_CONFIGS):
+            TBLaunchConfig.get(SOCKS_PORT + 2 + port_offset, CONTROL_PORT)
+        self.assertEqual(len(TBLaunchConfig._configs), MAX_CACHED_CONFIGS)
+        self.assertIsNot(config, TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT))
+
+    def test_prefs_should_be_frozen(self):
+        config = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT)
+        with self.assertRaises(TypeError):
+            config.prefs["foo"] = 1
+
+    def test_should_add_custom_ports_to_banned_ports(self):
+        config = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT)
+        for pref in cm.PORT_BAN_PREFS:
+            self.assertIn(str(SOCKS_PORT), config.prefs[pref])
+            self.assertIn(str(CONTROL_PORT), config.prefs[pref])
+
+    def test_pref_dict_should_overwrite_prefs(self):
+        config = TBLaunchConfig.get(
+            SOCKS_PORT, CONTROL_PORT,
+            pref_dict={"extensions.torlauncher.start_tor": True})
+        self.assertTrue(config.prefs["extensions.torlauncher.start_tor"])
+
+    def test_lean_preset_should_not_change_tor_prefs(self):
+        tor_prefs = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT).prefs
+        for pref in LEAN_PREFS:
+            self.assertNotIn(pref, tor_prefs)
+            self.assertFalse(pref.startswith(("privacy.", "network.proxy.",
+                                              "security.")))
+
+    def test_pref_dict_should_overwrite_preset(self):
+        prefs = apply_pref_preset(
+            "lean", {"network.prefetch-next": True, "foo": 1})
+        self.assertTrue(prefs["network.prefetch-next"])
+        self.assertEqual(prefs["foo"], 1)
+        self.assertFalse(prefs["network.predictor.enabled"])
+        self.assertEqual(apply_pref_preset(None, {"foo": 1}), {"foo": 1})
+
+    def test_should_write_user_js_to_profile_template(self):
+        profile_dir = tempfile.mkdtemp()
+        template_root = tempfile.mkdtemp()
+        config = TBLaunchConfig.get(SOCKS_PORT, CONTROL_PORT)
+        template_dir = config.make_profile_template(profile_dir,
+                                                    template_root)
+        self.assertEqual(read_file(join(template_dir, "user.js")),
+                         config.user_js())
+        self.assertIn('user_pref("network.proxy.socks_port", %s);'
+                      % SOCKS_PORT, config.user_js())
+        self.assertEqual(
+            config.make_profile_template(profile_dir, template_root),
+            template_dir)
+        self.assertEqual(len(listdir(template_root)), 1)
+        rmtree(profile_dir)
+        rmtree(template_root)
+
+
+if __name__ == "__main__":
+    unittest.main()
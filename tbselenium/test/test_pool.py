@@ -0,0 +1,112 @@
+import unittest
+from unittest.mock import patch
+from selenium.webdriver.firefox.options import Options
+from tbselenium.test import TBB_PATH
+from tbselenium.test.fixtures import TBDriverFixture
+from tbselenium.pool import TorBrowserDriverPool
+from tbselenium.exceptions import TBDriverPoolError
+from tbselenium.common import LOCAL_JS_TEST_URL, ABOUT_BLANK_URL
+
+
+class FakeDriver(object):
+    """Stands in for a driver, fails to launch when `fail` is set."""
+    fail = False
+
+    def __init__(self, tbb_path, options=None, **kwargs):
+        if FakeDriver.fail:
+            raise OSError("Launch failed")
+        self.is_running = True
+        self.options = options
+        if options is not None:
+            options.add_argument("-profile")
+
+    def quit(self, block=True):
+        self.is_running = False
+
+
+class TBDriverPoolTest(unittest.TestCase):
+
+    def test_should_reuse_driver_between_leases(self):
+        with TorBrowserDriverPool(TBB_PATH, size=1,
+                                  driver_class=TBDriverFixture) as pool:
+            with pool.lease() as driver:
+                driver.load_url(LOCAL_JS_TEST_URL)
+                first_driver = driver
+            with pool.lease() as driver:
+                self.assertIs(driver, first_driver)
+                self.assertEqual(driver.current_url, ABOUT_BLANK_URL)
+                self.assertEqual(pool.visit_count(driver), 1)
+
+    def test_should_recycle_driver_after_max_visits(self):
+        with TorBrowserDriverPool(TBB_PATH, size=1, max_visits=1,
+                                  driver_class=TBDriverFixture) as pool:
+            with pool.lease() as driver:
+                first_driver = driver
+            self.assertFalse(first_driver.is_running)
+            with pool.lease() as driver:
+                self.assertIsNot(driver, first_driver)
+                self.assertTrue(driver.is_running)
+
+    def test_should_recycle_driver_over_max_rss(self):
+        with TorBrowserDriverPool(TBB_PATH, size=1, max_rss=1,
+                                  driver_class=TBDriverFixture) as pool:
+            with pool.lease() as driver:
+                first_driver = driver
+            self.assertFalse(first_driver.is_running)
+            with pool.lease() as driver:
+                self.assertIsNot(driver, first_driver)
+
+    def test_should_recycle_driver_on_failure(self):
+        with TorBrowserDriverPool(TBB_PATH, size=1,
+                                  driver_class=TBDriverFixture) as pool:
+            with self.assertRaises(ValueError):
+                with pool.lease() as driver:
+                    first_driver = driver
+                    raise ValueError("Visit failed")
+            self.assertFalse(first_driver.is_running)
+            with pool.lease() as driver:
+                self.assertIsNot(driver, first_driver)
+
+    def test_should_raise_when_no_driver_is_available(self):
+        with TorBrowserDriverPool(TBB_PATH, size=1,
+                                  driver_class=TBDriverFixture) as pool:
+            with pool.lease():
+                with self.assertRaises(TBDriverPoolError):
+                    with pool.lease(timeout=0.1):
+                        pass
+
+    @patch("tbselenium.pool.RELAUNCH_RETRY_INTERVAL", 0)
+    def test_should_retry_failed_relaunch_on_next_lease(self):
+        FakeDriver.fail = False
+        self.addCleanup(setattr, FakeDriver, "fail", False)
+        with TorBrowserDriverPool(TBB_PATH, size=1, reset_fn=lambda d: None,
+                                  driver_class=FakeDriver) as pool:
+            # the visit's exception is not masked by the failing launch
+            with self.assertRaises(ValueError):
+                with pool.lease():
+                    FakeDriver.fail = True
+                    raise ValueError("Visit failed")
+            with self.assertRaises(TBDriverPoolError):
+                with pool.lease():
+                    pass
+            FakeDriver.fail = False
+            with pool.lease() as driver:
+                self.assertTrue(driver.is_running)
+
+    def test_should_copy_options_for_each_driver(self):
+        options = Options()
+        with TorBrowserDriverPool(TBB_PATH, size=2, reset_fn=lambda d: None,
+                                  driver_class=FakeDriver,
+                                  options=options) as pool:
+            with pool.lease() as driver1, pool.lease() as driver2:
+                self.assertIsNot(driver1.options, driver2.options)
+                self.assertEqual(driver2.options.arguments, ["-profile"])
+        self.assertEqual(options.arguments, [])
+
+    def test_should_raise_for_invalid_size(self):
+        with self.assertRaises(TBDriverPoolError):
+            TorBrowserDriverPool(TBB_PATH, size=0)
+
+
+if __name__ == "__main__":
+    unittest.main()
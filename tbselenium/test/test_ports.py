@@ -0,0 +1,73 @@
+import socket
+import tempfile
+from os import chmod
+from os.path import join
+import unittest
+from multiprocessing import Process, Queue
+from shutil import rmtree
+from tbselenium.ports import (lease_port, release_port, leased_ports,
+                              try_lock_port, is_port_bindable)
+
+
+def try_lock_port_in_child(port, lock_dir, result_queue):
+    lock_file = try_lock_port(port, lock_dir)
+    result_queue.put(lock_file is not None)
+
+
+class PortLeaseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.lock_dir, ignore_errors=True)
+
+    def is_locked_by_another_process(self, port):
+        result_queue = Queue()
+        child = Process(target=try_lock_port_in_child,
+                        args=(port, self.lock_dir, result_queue))
+        child.start()
+        child.join()
+        return not result_queue.get()
+
+    def test_should_lease_distinct_free_ports(self):
+        ports = [lease_port(self.lock_dir) for _ in range(10)]
+        self.assertEqual(len(set(ports)), 10)
+        for port in ports:
+            self.assertIn(port, leased_ports())
+            self.assertTrue(is_port_bindable(port))
+            release_port(port)
+        for port in ports:
+            self.assertNotIn(port, leased_ports())
+
+    def test_lease_should_be_visible_to_other_processes(self):
+        port = lease_port(self.lock_dir)
+        self.assertTrue(self.is_locked_by_another_process(port))
+        release_port(port)
+        self.assertFalse(self.is_locked_by_another_process(port))
+
+    def test_should_lease_without_lock_dir_of_another_user(self):
+        # a lock dir that others can write to is not trusted
+        chmod(self.lock_dir, 0o777)
+        port = lease_port(self.lock_dir)
+        self.assertIn(port, leased_ports())
+        release_port(port)
+        self.assertNotIn(port, leased_ports())
+
+    def test_should_lease_when_lock_dir_cannot_be_created(self):
+        lock_dir = join(self.lock_dir, "file", "locks")
+        open(join(self.lock_dir, "file"), "w").close()
+        port = lease_port(lock_dir)
+        self.assertTrue(is_port_bindable(port))
+        release_port(port)
+
+    def test_busy_port_is_not_bindable(self):
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.bind(("127.0.0.1", 0))
+        skt.listen(1)
+        self.assertFalse(is_port_bindable(skt.getsockname()[1]))
+        skt.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import unittest
+import tempfile
+from os import listdir, chmod
+from os.path import join
+from shutil import rmtree
+from tbselenium import common as cm
+from tbselenium.test import TBB_PATH
+from tbselenium.test.fixtures import TBDriverFixture
+from tbselenium.profile import (CachedFirefoxProfile, hash_profile_dir,
+                                MAX_MEMORY_CACHED_PROFILES)
+
+
+class ProfileCacheTest(unittest.TestCase):
+
+    TBB_PROFILE_PATH = join(TBB_PATH, cm.DEFAULT_TBB_PROFILE_PATH)
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.cache_dir, ignore_errors=True)
+
+    def test_should_write_encoded_profile_to_cache(self):
+        profile = CachedFirefoxProfile(self.TBB_PROFILE_PATH, self.cache_dir)
+        encoded = profile.encoded
+        self.assertEqual(listdir(self.cache_dir),
+                         ["%s.b64" % profile.cache_key])
+        CachedFirefoxProfile._memory_cache.clear()
+        profile = CachedFirefoxProfile(self.TBB_PROFILE_PATH, self.cache_dir)
+        self.assertEqual(profile.encoded, encoded)
+
+    def test_cache_key_should_depend_on_prefs(self):
+        self.assertNotEqual(
+            hash_profile_dir(self.TBB_PROFILE_PATH),
+            hash_profile_dir(self.TBB_PROFILE_PATH, {"foo": 1}))
+
+    def test_should_ignore_blob_writable_by_others(self):
+        profile = CachedFirefoxProfile(self.TBB_PROFILE_PATH, self.cache_dir)
+        profile.write_cached_blob("key", "blob")
+        self.assertEqual(profile.read_cached_blob("key"), "blob")
+        chmod(profile.cached_blob_path("key"), 0o666)
+        self.assertIsNone(profile.read_cached_blob("key"))
+        chmod(profile.cached_blob_path("key"), 0o600)
+        chmod(self.cache_dir, 0o777)
+        self.assertIsNone(profile.read_cached_blob("key"))
+
+    def test_should_keep_recent_profiles_in_memory(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, profile_dir)
+        CachedFirefoxProfile._memory_cache.clear()
+        for i in range(MAX_MEMORY_CACHED_PROFILES + 1):
+            profile = CachedFirefoxProfile(profile_dir, self.cache_dir)
+            profile.set_preference("foo", i)
+            profile.encoded
+        self.assertEqual(len(CachedFirefoxProfile._memory_cache),
+                         MAX_MEMORY_CACHED_PROFILES)
+
+    def test_should_launch_with_cached_profile(self):
+        for _ in range(2):
+            with TBDriverFixture(TBB_PATH,
+                                 profile_cache_dir=self.cache_dir) as driver:
+                driver.load_url_ensure(cm.LOCAL_JS_TEST_URL)
+        self.assertEqual(len(listdir(self.cache_dir)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
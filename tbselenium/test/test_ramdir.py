@@ -0,0 +1,45 @@
+import tempfile
+import unittest
+from os.path import basename, dirname, join
+from shutil import rmtree
+from tbselenium.ramdir import make_ram_dir, get_ram_dirs_size
+from tbselenium.exceptions import TBDriverRamDirError
+
+
+class RamDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ram_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.ram_root, ignore_errors=True)
+
+    def write_file(self, path, size):
+        with open(path, "wb") as f:
+            f.write(b"\0" * size)
+
+    def test_should_make_dir_under_ram_root(self):
+        ram_dir = make_ram_dir(self.ram_root)
+        self.assertEqual(dirname(ram_dir), self.ram_root)
+        self.assertTrue(basename(ram_dir).startswith("tbselenium-"))
+
+    def test_should_count_only_tbselenium_dirs(self):
+        ram_dir = make_ram_dir(self.ram_root)
+        self.write_file(join(ram_dir, "prefs.js"), 1000)
+        self.write_file(join(self.ram_root, "other"), 5000)
+        self.assertEqual(get_ram_dirs_size(self.ram_root), 1000)
+
+    def test_should_raise_when_budget_is_used_up(self):
+        ram_dir = make_ram_dir(self.ram_root, budget=1000)
+        self.write_file(join(ram_dir, "prefs.js"), 1000)
+        with self.assertRaises(TBDriverRamDirError):
+            make_ram_dir(self.ram_root, budget=1000)
+        make_ram_dir(self.ram_root, budget=2000)
+
+    def test_should_raise_for_missing_ram_root(self):
+        with self.assertRaises(TBDriverRamDirError):
+            make_ram_dir(join(self.ram_root, "missing"))
+
+
+if __name__ == "__main__":
+    unittest.main()
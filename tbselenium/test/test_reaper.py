@@ -0,0 +1,147 @@
+import os
+import json
+import tempfile
+import unittest
+import subprocess
+from os.path import isdir, isfile, join
+from shutil import rmtree
+from time import time
+from unittest.mock import patch
+from tbselenium.exceptions import TBDriverPathError
+from tbselenium.ramdir import RAM_DIR_PREFIX
+from tbselenium.reaper import (get_create_time, reap_orphans, read_markers,
+                               reap_stale_profile_dirs, is_reapable_dir,
+                               main)
+
+
+def get_dead_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+class ReaperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.marker_dir = tempfile.mkdtemp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            process.kill()
+            process.wait()
+        rmtree(self.marker_dir, ignore_errors=True)
+        rmtree(self.temp_dir, ignore_errors=True)
+
+    def start_process(self):
+        process = subprocess.Popen(["sleep", "60"])
+        self.processes.append(process)
+        return process
+
+    def write_marker(self, owner_pid, geckodriver, dirs):
+        marker = {
+            "owner_pid": owner_pid,
+            "owner_create_time": get_create_time(owner_pid),
+            "geckodriver_pid": geckodriver.pid,
+            "geckodriver_create_time": get_create_time(geckodriver.pid),
+            "browser_pid": None,
+            "browser_create_time": None,
+            "dirs": dirs,
+            "created": time(),
+            }
+        marker_path = join(self.marker_dir, "%d.json" % geckodriver.pid)
+        with open(marker_path, "w") as f:
+            json.dump(marker, f)
+        return marker_path
+
+    def test_should_reap_drivers_of_dead_processes(self):
+        geckodriver = self.start_process()
+        ram_dir = tempfile.mkdtemp(prefix=RAM_DIR_PREFIX, dir=self.temp_dir)
+        profile_dir = tempfile.mkdtemp(prefix="rust_mozprofile", dir=ram_dir)
+        marker_path = self.write_marker(get_dead_pid(), geckodriver,
+                                        [ram_dir, profile_dir])
+        reaped = reap_orphans(self.marker_dir)
+        self.assertEqual(len(reaped), 1)
+        self.assertIsNotNone(geckodriver.wait(timeout=5))
+        self.assertFalse(isdir(ram_dir))
+        self.assertFalse(isfile(marker_path))
+
+    def test_should_only_remove_driver_dirs(self):
+        other_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        profile_dir = tempfile.mkdtemp(prefix="rust_mozprofile",
+                                       dir=self.temp_dir)
+        self.assertFalse(is_reapable_dir(other_dir))
+        # profiles are only expected in the temp dir or in a RAM dir
+        self.assertFalse(is_reapable_dir(profile_dir))
+        self.assertTrue(is_reapable_dir(profile_dir, [self.temp_dir]))
+        self.write_marker(get_dead_pid(), self.start_process(),
+                          [other_dir, profile_dir])
+        reap_orphans(self.marker_dir)
+        self.assertTrue(isdir(other_dir))
+        self.assertTrue(isdir(profile_dir))
+
+    def test_should_skip_markers_writable_by_others(self):
+        marker_path = self.write_marker(get_dead_pid(),
+                                        self.start_process(), [])
+        os.chmod(marker_path, 0o666)
+        self.assertEqual(read_markers(self.marker_dir), [])
+        os.chmod(marker_path, 0o644)
+        self.assertEqual(len(read_markers(self.marker_dir)), 1)
+        os.chmod(self.marker_dir, 0o777)
+        with self.assertRaises(TBDriverPathError):
+            read_markers(self.marker_dir)
+
+    def test_should_not_reap_drivers_of_live_processes(self):
+        geckodriver = self.start_process()
+        profile_dir = tempfile.mkdtemp(dir=self.temp_dir)
+        marker_path = self.write_marker(os.getpid(), geckodriver,
+                                        [profile_dir])
+        self.assertEqual(reap_orphans(self.marker_dir), [])
+        self.assertIsNone(geckodriver.poll())
+        self.assertTrue(isdir(profile_dir))
+        self.assertTrue(isfile(marker_path))
+
+    def test_should_not_reap_without_psutil(self):
+        geckodriver = self.start_process()
+        profile_dir = tempfile.mkdtemp(prefix="rust_mozprofile",
+                                       dir=self.temp_dir)
+        os.utime(profile_dir, (time() - 7200, time() - 7200))
+        marker_path = self.write_marker(os.getpid(), geckodriver,
+                                        [profile_dir])
+        with patch("tbselenium.reaper.psutil", None):
+            self.assertEqual(reap_orphans(self.marker_dir), [])
+            self.assertEqual(reap_stale_profile_dirs(
+                3600, self.temp_dir, self.marker_dir), [])
+            self.assertEqual(main(["--marker-dir", self.marker_dir]), 1)
+        self.assertIsNone(geckodriver.poll())
+        self.assertTrue(isdir(profile_dir))
+        self.assertTrue(isfile(marker_path))
+
+    def test_should_not_reap_in_dry_run(self):
+        geckodriver = self.start_process()
+        marker_path = self.write_marker(get_dead_pid(), geckodriver, [])
+        self.assertEqual(len(reap_orphans(self.marker_dir, dry_run=True)),
+                         1)
+        self.assertIsNone(geckodriver.poll())
+        self.assertTrue(isfile(marker_path))
+
+    def test_should_remove_stale_unmarked_profiles(self):
+        stale_dir = tempfile.mkdtemp(prefix="rust_mozprofile",
+                                     dir=self.temp_dir)
+        os.utime(stale_dir, (time() - 7200, time() - 7200))
+        live_dir = tempfile.mkdtemp(prefix="rust_mozprofile",
+                                    dir=self.temp_dir)
+        os.utime(live_dir, (time() - 7200, time() - 7200))
+        self.write_marker(os.getpid(), self.start_process(), [live_dir])
+        new_dir = tempfile.mkdtemp(prefix="rust_mozprofile",
+                                   dir=self.temp_dir)
+        removed = reap_stale_profile_dirs(3600, self.temp_dir,
+                                          self.marker_dir)
+        self.assertEqual(removed, [stale_dir])
+        self.assertTrue(isdir(live_dir))
+        self.assertTrue(isdir(new_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
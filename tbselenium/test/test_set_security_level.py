@@ -6,6 +6,7 @@ from tbselenium.test.fixtures import TBDriverFixture
 from tbselenium.test import TBB_PATH
 from tbselenium.common import LOCAL_JS_TEST_URL
 from tbselenium.utils import set_security_level, get_js_status_text
+from tbselenium.utils import set_tbb_pref, get_tbb_pref, TB_SECURITY_SLIDER_PREF
 from tbselenium.utils import (
     TB_SECURITY_LEVEL_SAFEST,
     TB_SECURITY_LEVEL_SAFER,
@@ -96,6 +97,30 @@ class SecurityLevelTest(unittest.TestCase):
             except (NoSuchElementException, TimeoutException):
                 self.fail("Security level cannot be set to 'Safest'")
 
+    def test_set_security_safest_via_ui(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            set_security_level(driver, TB_SECURITY_LEVEL_SAFEST, use_ui=True)
+            driver.load_url_ensure(LOCAL_JS_TEST_URL)
+            js_status = get_js_status_text(driver)
+            assert js_status == "JavaScript is disabled."
+
+    def test_set_security_safest_at_launch(self):
+        with TBDriverFixture(TBB_PATH,
+                             security_level=TB_SECURITY_LEVEL_SAFEST) as driver:
+            self.assertEqual(driver.security_level, TB_SECURITY_LEVEL_SAFEST)
+            driver.load_url_ensure(LOCAL_JS_TEST_URL)
+            js_status = get_js_status_text(driver)
+            assert js_status == "JavaScript is disabled."
+
+    def test_should_skip_setting_current_security_level(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            set_security_level(driver, TB_SECURITY_LEVEL_SAFER)
+            self.assertEqual(driver.security_level, TB_SECURITY_LEVEL_SAFER)
+            # the cached level is trusted, so this must not touch the prefs
+            set_tbb_pref(driver, TB_SECURITY_SLIDER_PREF, 4)
+            set_security_level(driver, TB_SECURITY_LEVEL_SAFER)
+            self.assertEqual(get_tbb_pref(driver, TB_SECURITY_SLIDER_PREF), 4)
+
 
 if __name__ == "__main__":
     unittest.main()
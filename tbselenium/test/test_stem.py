@@ -53,6 +53,35 @@ class TBStemTest(unittest.TestCase):
         ccts = self.controller.get_circuits()
         self.assertGreater(len(ccts), 0)
 
+    def test_new_identity(self):
+        driver = self.driver
+        driver.load_url_ensure(cm.CHECK_TPO_URL)
+        driver.execute_script("window.open('about:tor');"
+                              "localStorage.setItem('foo', 'bar');")
+        self.assertTrue(driver.new_identity())
+        self.assertEqual(len(driver.window_handles), 1)
+        self.assertEqual(driver.current_url, cm.ABOUT_BLANK_URL)
+        self.assertEqual(driver.get_cookies(), [])
+        driver.load_url_ensure(cm.CHECK_TPO_URL)
+        self.assertIsNone(
+            driver.execute_script("return localStorage.getItem('foo');"))
+
+    def test_should_record_tor_events_per_visit(self):
+        records = []
+        with TBDriverFixture(TBB_PATH, tor_cfg=cm.USE_STEM,
+                             socks_port=self.socks_port,
+                             control_port=self.control_port,
+                             record_tor_events=True,
+                             visit_record_callback=records.append) as driver:
+            driver.load_url(cm.CHECK_TPO_URL, wait_on_page=1,
+                            visit_id="check-tpo")
+        record = records[0]
+        self.assertEqual(record["visit_id"], "check-tpo")
+        self.assertGreater(record["bytes_read"], 0)
+        self.assertGreater(record["streams"], 0)
+        self.assertGreater(len(record["circuits"]), 0)
+        self.assertIsNotNone(record["time_to_first_stream"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,17 +1,25 @@
+import json
 import tempfile
 import unittest
 import pytest
-from os import environ
-from os.path import join, isdir, getmtime
+from os import environ, getcwd, listdir
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, isdir, isfile, getmtime
 from time import time
+from shutil import rmtree
 
+from selenium.webdriver.common.by import By
 from selenium.webdriver.common.timeouts import Timeouts
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 from tbselenium import common as cm
 from tbselenium.test import TBB_PATH
 from tbselenium.test.fixtures import TBDriverFixture
+from tbselenium.tbdriver import TBService
 from selenium.webdriver.common.utils import free_port
-from tbselenium.utils import is_busy
+from tbselenium.utils import is_busy, is_browser_ready
+from tbselenium.reaper import live_drivers
+from tbselenium.ports import leased_ports
+from tbselenium.exceptions import TimeExceededError, TBDriverConfigError
 
 
 class TBDriverTest(unittest.TestCase):
@@ -35,13 +43,37 @@ class TBDriverTest(unittest.TestCase):
             'Tor Project | Anonymity Online',
             self.tb_driver.title)
 
+    def test_should_be_ready_after_init(self):
+        self.assertTrue(is_browser_ready(self.tb_driver,
+                                         cm.NO_SCRIPT_ADDON_ID))
+
     def test_should_check_environ_in_prepend(self):
         self.tb_driver.quit()
         self.tb_driver = TBDriverFixture(TBB_PATH)
-        paths = environ["PATH"].split(':')
+        paths = self.tb_driver.tbb_env["PATH"].split(':')
         tbbpath_count = paths.count(self.tb_driver.tbb_browser_dir)
         self.assertEqual(tbbpath_count, 1)
 
+    def test_should_not_modify_process_environ_and_cwd(self):
+        self.assertNotEqual(environ.get("HOME"),
+                            self.tb_driver.tbb_browser_dir)
+        self.assertNotEqual(getcwd(), self.tb_driver.tbb_browser_dir)
+        self.assertEqual(self.tb_driver.tbb_env["HOME"],
+                         self.tb_driver.tbb_browser_dir)
+
+    def test_should_launch_drivers_from_threads(self):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            drivers = list(executor.map(
+                lambda _: TBDriverFixture(TBB_PATH), range(2)))
+        try:
+            for driver in drivers:
+                driver.load_url_ensure(cm.LOCAL_JS_TEST_URL)
+                self.assertEqual(driver.find_element_by("#js").text,
+                                 "JavaScript is enabled.")
+        finally:
+            for driver in drivers:
+                driver.quit()
+
     def test_should_set_timeouts(self):
         LOW_PAGE_LOAD_LIMIT = 0.05
         self.tb_driver.timeouts = Timeouts(page_load=LOW_PAGE_LOAD_LIMIT)
@@ -57,6 +89,58 @@ class TBDriverTest(unittest.TestCase):
             assert timed_out
 
 
+class TBDriverResourceUsage(unittest.TestCase):
+
+    def test_should_sample_resource_usage(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            usage = driver.resource_usage()
+            # geckodriver, the browser and its content processes
+            self.assertGreater(usage["n_processes"], 2)
+            self.assertGreater(usage["rss"], 0)
+            self.assertIsNone(usage["cpu_percent"])
+            driver.load_url(cm.LOCAL_JS_TEST_URL)
+            self.assertGreaterEqual(driver.resource_usage()["cpu_percent"],
+                                    0)
+        self.assertIsNone(driver.resource_usage())
+
+
+class TBDriverPrefPreset(unittest.TestCase):
+
+    def test_should_launch_with_lean_preset(self):
+        with TBDriverFixture(TBB_PATH, preset="lean") as driver:
+            self.assertFalse(
+                driver.options.preferences["network.predictor.enabled"])
+            driver.load_url_ensure(cm.CHECK_TPO_URL)
+            driver.find_element_by("h1.on")
+
+    def test_should_raise_for_unknown_preset(self):
+        with self.assertRaises(TBDriverConfigError):
+            TBDriverFixture(TBB_PATH, preset="fast")
+
+
+class TBDriverRamDir(unittest.TestCase):
+
+    def setUp(self):
+        self.ram_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.ram_root, ignore_errors=True)
+
+    def test_should_place_profile_under_ram_dir(self):
+        with TBDriverFixture(TBB_PATH, ram_dir=self.ram_root) as driver:
+            ram_dir = driver.ram_dir
+            self.assertTrue(driver.temp_profile_dir.startswith(ram_dir))
+            self.assertEqual(driver.tbb_env["TMPDIR"], ram_dir)
+        self.assertFalse(isdir(ram_dir))
+
+    def test_should_remove_ram_dir_when_quit_fails(self):
+        driver = TBDriverFixture(TBB_PATH, ram_dir=self.ram_root)
+        ram_dir = driver.ram_dir
+        driver.service.process.kill()
+        driver.quit()
+        self.assertFalse(isdir(ram_dir))
+
+
 class TBDriverCleanUp(unittest.TestCase):
     def setUp(self):
         self.tb_driver = TBDriverFixture(TBB_PATH)
@@ -74,6 +158,64 @@ class TBDriverCleanUp(unittest.TestCase):
         self.tb_driver.quit()
         self.assertFalse(isdir(temp_profile_dir))
 
+    def test_should_kill_browser_after_deadline(self):
+        driver = self.tb_driver
+        geckodriver_process = driver.service.process
+        temp_profile_dir = driver.temp_profile_dir
+        with self.assertRaises(TimeExceededError):
+            with driver.deadline(1):
+                driver.execute_script(
+                    "const end = Date.now() + 10000;"
+                    "while (Date.now() < end) {}")
+        self.assertNotEqual(geckodriver_process.poll(), None)
+        self.assertFalse(isdir(temp_profile_dir))
+        driver.quit()
+
+    def test_should_quit_within_deadline(self):
+        geckodriver_process = self.tb_driver.service.process
+        self.tb_driver.quit(timeout=30)
+        self.assertNotEqual(geckodriver_process.poll(), None)
+
+    def test_should_remove_owner_marker_on_quit(self):
+        owner_marker = self.tb_driver.owner_marker
+        with open(owner_marker) as f:
+            marker = json.load(f)
+        self.assertEqual(marker["geckodriver_pid"],
+                         self.tb_driver.service.process.pid)
+        self.assertIn(self.tb_driver.temp_profile_dir, marker["dirs"])
+        self.tb_driver.quit()
+        self.assertFalse(isfile(owner_marker))
+
+    def test_should_quit_in_background(self):
+        geckodriver_process = self.tb_driver.service.process
+        temp_profile_dir = self.tb_driver.temp_profile_dir
+        future = self.tb_driver.quit(block=False)
+        self.assertFalse(self.tb_driver.is_running)
+        future.result(timeout=60)
+        self.assertNotEqual(geckodriver_process.poll(), None)
+        self.assertFalse(isdir(temp_profile_dir))
+
+
+class TBDriverFailedLaunch(unittest.TestCase):
+
+    def test_should_quit_if_startup_callback_fails(self):
+        def fail(startup_timings):
+            raise ValueError("Callback failed")
+
+        with self.assertRaises(ValueError):
+            TBDriverFixture(TBB_PATH, startup_timings_callback=fail)
+        self.assertEqual(live_drivers(), [])
+
+    def test_should_clean_up_if_geckodriver_fails_to_start(self):
+        ram_root = tempfile.mkdtemp()
+        self.addCleanup(rmtree, ram_root, ignore_errors=True)
+        ports_before = leased_ports()
+        with self.assertRaises(Exception):
+            TBDriverFixture(TBB_PATH, ram_dir=ram_root, record_traffic=True,
+                            executable_path="/nonexistent/geckodriver")
+        self.assertEqual(listdir(ram_root), [])
+        self.assertEqual(leased_ports(), ports_before)
+
 
 class TBDriverTorDataDir(unittest.TestCase):
 
@@ -128,6 +270,23 @@ class TBDriverProfile(unittest.TestCase):
         mod_time_after = getmtime(self.TBB_PROFILE_PATH)
         self.assertEqual(mod_time_before, mod_time_after)
 
+    def test_should_run_custom_profiles_in_parallel(self):
+        """Each stateful browser should get its own Marionette port."""
+        profile_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        drivers = [TBDriverFixture(TBB_PATH, tbb_profile_path=profile_dir,
+                                   use_custom_profile=True)
+                   for profile_dir in profile_dirs]
+        try:
+            marionette_ports = [driver.marionette_port for driver in drivers]
+            self.assertNotEqual(marionette_ports[0], marionette_ports[1])
+            for driver in drivers:
+                driver.load_url_ensure(cm.LOCAL_JS_TEST_URL)
+        finally:
+            for driver in drivers:
+                driver.quit()
+        for driver in drivers:
+            self.assertEqual(driver.leased_ports, [])
+
 
 class TBDriverCustomGeckoDriverPort(unittest.TestCase):
 
@@ -140,6 +299,108 @@ class TBDriverCustomGeckoDriverPort(unittest.TestCase):
         # check if the port is closed after we quit
         self.assertFalse(is_busy(random_port))
 
+    def test_should_pass_leased_websocket_port(self):
+        service = TBService(executable_path="geckodriver",
+                            websocket_port=12345)
+        args = service.command_line_args()
+        self.assertEqual(args.count("--websocket-port"), 1)
+        self.assertEqual(args[args.index("--websocket-port") + 1], "12345")
+
+
+class TBDriverStartupTimings(unittest.TestCase):
+
+    STARTUP_PHASES = ["setup_tbb_paths", "init_ports", "init_prefs",
+                      "export_env_vars", "geckodriver_service",
+                      "session_handshake", "install_extensions",
+                      "wait_until_ready"]
+
+    def test_should_record_startup_timings(self):
+        reported_timings = []
+        with TBDriverFixture(
+                TBB_PATH,
+                startup_timings_callback=reported_timings.append) as driver:
+            timings = driver.startup_timings
+            self.assertEqual(list(timings), self.STARTUP_PHASES)
+            self.assertTrue(all(t >= 0 for t in timings.values()))
+            self.assertEqual(reported_timings, [timings])
+
+
+class TBDriverLoadCompletion(unittest.TestCase):
+
+    def test_should_wait_for_selector(self):
+        with TBDriverFixture(TBB_PATH, page_load_strategy="eager") as driver:
+            driver.load_url(cm.LOCAL_JS_TEST_URL, wait_for_selector="#js")
+            self.assertEqual(driver.find_element_by("#js").text,
+                             "JavaScript is enabled.")
+
+    def test_should_wait_for_js_predicate(self):
+        with TBDriverFixture(TBB_PATH, page_load_strategy="none") as driver:
+            driver.load_url(
+                cm.LOCAL_IMG_TEST_URL,
+                wait_for_js="return document.readyState === 'complete'")
+
+    def test_should_not_check_previous_document(self):
+        with TBDriverFixture(TBB_PATH, page_load_strategy="none") as driver:
+            driver.load_url(cm.LOCAL_JS_TEST_URL, wait_for_selector="#js")
+            driver.load_url(cm.LOCAL_IMG_TEST_URL,
+                            wait_for_js="return !!document.body")
+            self.assertEqual(driver.current_url, cm.LOCAL_IMG_TEST_URL)
+            self.assertEqual(len(driver.find_elements(By.ID, "js")), 0)
+
+    def test_should_wait_for_network_idle(self):
+        idle_ms = 500
+        with TBDriverFixture(TBB_PATH) as driver:
+            driver.load_url(cm.LOCAL_IMG_TEST_URL, network_idle_ms=idle_ms)
+            idle_time = driver.execute_script(
+                "return performance.now() - performance.getEntriesByType("
+                "'navigation')[0].responseEnd")
+            self.assertGreaterEqual(idle_time, idle_ms)
+
+    def test_should_time_out_when_page_is_not_complete(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            with self.assertRaises(TimeoutException):
+                driver.load_url(cm.LOCAL_JS_TEST_URL,
+                                wait_for_js="return false",
+                                completion_timeout=0.5)
+
+
+class TBDriverConnectionError(unittest.TestCase):
+
+    def test_should_classify_connection_error(self):
+        # nothing should be listening on port 1
+        with TBDriverFixture(TBB_PATH) as driver:
+            try:
+                driver.load_url("http://127.0.0.1:1/")
+            except WebDriverException:
+                pass  # geckodriver may raise for error pages
+            self.assertTrue(driver.is_connection_error_page)
+            self.assertIsNotNone(driver.connection_error)
+
+    def test_should_not_flag_regular_page(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            driver.load_url(cm.LOCAL_JS_TEST_URL)
+            self.assertIsNone(driver.connection_error)
+            self.assertFalse(driver.is_connection_error_page)
+
+
+class TBDriverTrafficTrace(unittest.TestCase):
+
+    def test_should_record_traffic_trace(self):
+        trace_path = join(tempfile.mkdtemp(), "trace.jsonl")
+        with TBDriverFixture(TBB_PATH, record_traffic=True) as driver:
+            self.assertNotEqual(driver.browser_socks_port, driver.socks_port)
+            with driver.traffic_trace(trace_path):
+                driver.load_url(cm.CHECK_TPO_URL)
+        with open(trace_path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertTrue(any(r.get("dir") == "in" for r in records))
+
+    def test_should_raise_if_traffic_is_not_recorded(self):
+        with TBDriverFixture(TBB_PATH) as driver:
+            with self.assertRaises(TBDriverConfigError):
+                with driver.traffic_trace("trace.jsonl"):
+                    pass
+
 
 class TBDriverHeadless(unittest.TestCase):
 
@@ -0,0 +1,64 @@
+import unittest
+import pytest
+from tbselenium.torevents import TorEventRecorder
+
+try:
+    from stem.response import ControlMessage
+except ImportError as err:
+    pytest.skip("Can't import Stem. Skipping test: %s" % err)
+
+RELAY_1 = "A" * 40
+RELAY_2 = "B" * 40
+
+
+def parse_event(line):
+    return ControlMessage.from_str("650 %s\r\n" % line, "EVENT")
+
+
+class TorEventRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        # the recorder is not started, we pass it the events ourselves
+        self.recorder = TorEventRecorder(control_port=None, max_events=10)
+
+    def visit(self, visit_id, *lines):
+        self.recorder.begin_visit(visit_id)
+        for line in lines:
+            self.recorder.handle_event(parse_event(line))
+        return self.recorder.end_visit()
+
+    def test_should_summarize_visit(self):
+        record = self.visit(
+            "v1",
+            "CIRC 5 BUILT $%s~relay1,$%s~relay2 PURPOSE=GENERAL"
+            % (RELAY_1, RELAY_2),
+            "STREAM 12 NEW 0 example.com:80",
+            "STREAM 12 SUCCEEDED 5 93.184.216.34:80",
+            "BW 1000 200",
+            "BW 3000 400")
+        self.assertEqual(record["visit_id"], "v1")
+        self.assertEqual(record["bytes_read"], 4000)
+        self.assertEqual(record["bytes_written"], 600)
+        self.assertEqual(record["streams"], 1)
+        self.assertEqual(record["circuits"],
+                         [{"id": "5", "path": [RELAY_1, RELAY_2]}])
+        self.assertGreaterEqual(record["time_to_first_stream"], 0)
+        self.assertEqual(record["dropped_events"], 0)
+
+    def test_should_ignore_events_outside_visits(self):
+        self.recorder.handle_event(parse_event("BW 1000 200"))
+        record = self.visit("v2", "BW 10 20")
+        self.assertEqual(record["bytes_read"], 10)
+        self.assertIsNone(record["time_to_first_stream"])
+        self.recorder.handle_event(parse_event("BW 1000 200"))
+        self.assertEqual(len(self.recorder.events), 1)
+
+    def test_should_bound_the_event_buffer(self):
+        record = self.visit("v3", *["BW 1 1"] * 25)
+        self.assertEqual(len(self.recorder.events), 10)
+        self.assertEqual(record["bytes_read"], 10)
+        self.assertEqual(record["dropped_events"], 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
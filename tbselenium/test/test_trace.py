@@ -0,0 +1,156 @@
+import json
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+import socketserver
+from os.path import join
+from shutil import rmtree
+from tbselenium.trace import SocksRecorder
+from tbselenium.test.socks_server import LocalSocksServer
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            self.request.sendall(data)
+
+
+def connect_via_socks(socks_port, port):
+    """Open a connection to localhost:port through the SOCKS proxy."""
+    sock = socket.create_connection(("127.0.0.1", socks_port), timeout=5)
+    sock.sendall(b"\x05\x01\x00")
+    assert sock.recv(2) == b"\x05\x00"
+    sock.sendall(b"\x05\x01\x00\x01" + socket.inet_aton("127.0.0.1") +
+                 struct.pack("!H", port))
+    assert recv_exactly(sock, 10)[1] == 0
+    return sock
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        data += sock.recv(size - len(data))
+    return data
+
+
+def read_trace(trace_path):
+    with open(trace_path) as f:
+        return [json.loads(line) for line in f]
+
+
+class SocksRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.echo_server = socketserver.ThreadingTCPServer(
+            ("127.0.0.1", 0), EchoHandler)
+        self.echo_server.daemon_threads = True
+        threading.Thread(target=self.echo_server.serve_forever,
+                         daemon=True).start()
+        self.echo_port = self.echo_server.server_address[1]
+        self.socks_server = LocalSocksServer()
+        self.socks_server.start()
+        self.recorder = SocksRecorder(self.socks_server.port)
+        self.recorder.start()
+
+    def tearDown(self):
+        self.recorder.stop()
+        self.socks_server.__exit__()
+        self.echo_server.shutdown()
+        self.echo_server.server_close()
+        rmtree(self.tmp_dir, ignore_errors=True)
+
+    def echo(self, payload):
+        with connect_via_socks(self.recorder.port, self.echo_port) as sock:
+            sock.sendall(payload)
+            self.assertEqual(recv_exactly(sock, len(payload)), payload)
+
+    def test_should_relay_and_record_traffic(self):
+        trace_path = join(self.tmp_dir, "trace.jsonl")
+        payload = b"x" * 300000
+        self.recorder.start_trace(trace_path)
+        self.echo(payload)
+        self.recorder.stop()
+        records = read_trace(trace_path)
+        self.assertEqual(records[0]["event"], "open")
+        self.assertEqual(records[-1]["event"], "close")
+        sizes = {"in": 0, "out": 0}
+        for record in records[1:-1]:
+            sizes[record["dir"]] += record["len"]
+        # the SOCKS handshake is recorded with the payload
+        self.assertEqual(sizes["out"], 3 + 10 + len(payload))
+        self.assertEqual(sizes["in"], 2 + 10 + len(payload))
+        timestamps = [record["t"] for record in records]
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_should_record_to_separate_traces(self):
+        trace_paths = [join(self.tmp_dir, "%d.jsonl" % i) for i in range(2)]
+        for trace_path in trace_paths:
+            self.recorder.start_trace(trace_path)
+            self.echo(b"hello")
+            self.recorder.stop_trace()
+        # a connection may close after the trace it's opened in stopped
+        opened = [[r["conn"] for r in read_trace(trace_path)
+                   if r.get("event") == "open"]
+                  for trace_path in trace_paths]
+        self.assertEqual(opened, [[1], [2]])
+
+    def test_should_not_record_without_trace(self):
+        self.echo(b"hello")
+        trace_path = join(self.tmp_dir, "trace.jsonl")
+        self.recorder.start_trace(trace_path)
+        self.recorder.stop_trace()
+        # the connection may be closed after the trace started
+        self.assertEqual([r for r in read_trace(trace_path)
+                          if r.get("event") != "close"], [])
+
+    def test_should_relay_concurrent_connections(self):
+        trace_path = join(self.tmp_dir, "trace.jsonl")
+        self.recorder.start_trace(trace_path)
+        threads = [threading.Thread(target=self.echo, args=(b"y" * 10000,))
+                   for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.recorder.stop_trace()
+        opened = [r for r in read_trace(trace_path)
+                  if r.get("event") == "open"]
+        self.assertEqual(len(opened), 20)
+
+    def test_should_survive_errors_on_a_connection(self):
+        relay = self.recorder.relay
+        calls = []
+
+        def fail_once(conn, sock):
+            if not calls:
+                calls.append(conn)
+                raise KeyError("unexpected")
+            return relay(conn, sock)
+
+        self.recorder.relay = fail_once
+        # the first connection is closed
+        with self.assertRaises((OSError, AssertionError)):
+            self.echo(b"hello")
+        self.echo(b"hello")
+
+    def test_should_close_connection_if_upstream_refuses(self):
+        skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        skt.bind(("127.0.0.1", 0))
+        closed_port = skt.getsockname()[1]
+        skt.close()
+        recorder = SocksRecorder(closed_port)
+        recorder.start()
+        self.addCleanup(recorder.stop)
+        with socket.create_connection(("127.0.0.1", recorder.port),
+                                      timeout=5) as sock:
+            self.assertEqual(sock.recv(1), b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,14 @@
 import unittest
+import tempfile
+import subprocess
+from unittest.mock import patch
 import tbselenium.utils as ut
-from os.path import realpath
-from os import environ
+import tbselenium.common as cm
+from tbselenium.exceptions import TBDriverPathError
+from os.path import realpath, join, dirname
+from os import environ, listdir, utime, getpid, chmod, stat
+from shutil import rmtree
+from time import time
 
 
 class UtilsTest(unittest.TestCase):
@@ -26,6 +33,63 @@ class UtilsTest(unittest.TestCase):
         ut.prepend_to_env_var("non_existent_env_var", value1)
         self.assertEqual(environ["non_existent_env_var"], value1)
 
+    def test_get_process_tree_usage(self):
+        usage = ut.get_process_tree_usage(getpid())
+        self.assertGreaterEqual(usage["n_processes"], 1)
+        self.assertGreater(usage["rss"], 0)
+        self.assertGreater(usage["cpu_time"], 0)
+
+    def test_seed_tor_data_dir(self):
+        seed_dir = tempfile.mkdtemp()
+        data_dir = join(tempfile.mkdtemp(), "tor_data")
+        consensus_path = join(seed_dir, cm.TOR_CONSENSUS_FILE)
+        with open(consensus_path, "w") as f:
+            f.write("consensus")
+        self.assertFalse(ut.is_tor_data_seed_stale(seed_dir))
+        ut.seed_tor_data_dir(data_dir, seed_dir)
+        self.assertEqual(listdir(data_dir), [cm.TOR_CONSENSUS_FILE])
+        old_mtime = time() - cm.TOR_DATA_SEED_MAX_AGE - 1
+        utime(consensus_path, (old_mtime, old_mtime))
+        self.assertTrue(ut.is_tor_data_seed_stale(seed_dir))
+        ut.update_tor_data_seed(seed_dir, data_dir)
+        self.assertEqual(listdir(seed_dir), [cm.TOR_CONSENSUS_FILE])
+        self.assertFalse(ut.is_tor_data_seed_stale(seed_dir))
+        rmtree(seed_dir)
+        rmtree(dirname(data_dir))
+
+    def test_empty_tor_data_seed_is_stale(self):
+        self.assertTrue(ut.is_tor_data_seed_stale(tempfile.mkdtemp()))
+
+    def test_launch_should_not_fail_on_seed_refresh_error(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+        tor_binary = join(tmp_dir, "tor")
+        open(tor_binary, "w").close()
+        # the seed can't be created under a file
+        open(join(tmp_dir, "file"), "w").close()
+        torrc = {"DataDirectory": join(tmp_dir, "data")}
+        with patch.dict(environ), \
+                patch("tbselenium.utils.launch_tor_with_config", create=True,
+                      return_value="tor_process"):
+            self.assertEqual(ut.launch_tbb_tor_with_stem(
+                torrc=torrc, tor_binary=tor_binary,
+                data_dir_seed=join(tmp_dir, "file", "seed")), "tor_process")
+
+    def test_kill_process_tree_without_psutil(self):
+        process = subprocess.Popen(["sleep", "60"])
+        with patch("tbselenium.utils.psutil", None):
+            ut.kill_process_tree(process.pid)
+        self.assertIsNotNone(process.wait(timeout=5))
+
+    def test_make_private_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(rmtree, tmp_dir)
+        private_dir = ut.make_private_dir(join(tmp_dir, "private"))
+        self.assertEqual(stat(private_dir).st_mode & 0o777, 0o700)
+        chmod(private_dir, 0o777)
+        with self.assertRaises(TBDriverPathError):
+            ut.make_private_dir(private_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
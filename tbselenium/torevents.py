@@ -0,0 +1,128 @@
+import threading
+from collections import deque
+from time import time
+import tbselenium.common as cm
+
+try:  # only needed for recording tor events
+    from stem import ControllerError
+    from stem.control import Controller, EventType
+except ImportError:
+    pass
+
+
+class TorEventRecorder(object):
+    """Record tor's circuit, stream and bandwidth events per visit.
+
+    Events that arrive between begin_visit() and end_visit() are tagged
+    with the visit ID and kept in a ring buffer of `max_events`, so that
+    a long visit can't use up the memory. end_visit() returns a summary
+    of the visit:
+
+        {"visit_id": 1, "duration": 3.2, "bytes_read": 51234,
+         "bytes_written": 4321, "circuits": [{"id": "5", "path": [...]}],
+         "streams": 7, "time_to_first_stream": 0.31, "dropped_events": 0}
+
+    Bytes are summed from tor's BW events, which tor sends once per second,
+    so they are rounded to whole seconds around the visit. Requires Stem.
+
+    Events cover every client of the tor process: if other browsers or
+    programs use the same tor, their circuits, streams and bytes are
+    counted in the visit too.
+    """
+    def __init__(self, control_port, password=None,
+                 max_events=cm.TOR_EVENT_BUFFER_SIZE):
+        self.control_port = control_port
+        self.password = password
+        self.events = deque(maxlen=max_events)
+        self.controller = None
+        self.visit_id = None
+        self.visit_start = None
+        self.n_visit_events = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.controller = Controller.from_port(port=self.control_port)
+        self.controller.authenticate(password=self.password)
+        self.controller.add_event_listener(
+            self.handle_event, EventType.CIRC, EventType.STREAM,
+            EventType.BW)
+
+    def stop(self):
+        if self.controller is not None:
+            self.controller.close()
+            self.controller = None
+
+    def handle_event(self, event):
+        """Store a compact tuple for the events of the current visit."""
+        with self._lock:
+            if self.visit_id is None:
+                return
+            if event.type == "BW":
+                fields = (event.read, event.written)
+            elif event.type == "STREAM":
+                fields = (event.id, event.status, event.circ_id)
+            else:  # CIRC
+                path = event.path or []
+                fields = (event.id, event.status,
+                          [fingerprint for fingerprint, _ in path])
+            self.events.append((self.visit_id, time(), event.type, fields))
+            self.n_visit_events += 1
+
+    def begin_visit(self, visit_id):
+        with self._lock:
+            self.events.clear()
+            self.visit_id = visit_id
+            self.visit_start = time()
+            self.n_visit_events = 0
+
+    def end_visit(self):
+        """Stop tagging events and return the summary of the visit."""
+        with self._lock:
+            visit_id, self.visit_id = self.visit_id, None
+            events = [e for e in self.events if e[0] == visit_id]
+            record = {
+                "visit_id": visit_id,
+                "duration": time() - self.visit_start,
+                "bytes_read": 0,
+                "bytes_written": 0,
+                "circuits": [],
+                "streams": 0,
+                "time_to_first_stream": None,
+                "dropped_events": self.n_visit_events - len(events),
+                }
+        circuit_paths = {}
+        circuit_ids = []
+        stream_ids = set()
+        for _, t, event_type, fields in events:
+            if event_type == "BW":
+                record["bytes_read"] += fields[0]
+                record["bytes_written"] += fields[1]
+            elif event_type == "CIRC":
+                circ_id, _, path = fields
+                if path:
+                    circuit_paths[circ_id] = path
+            else:
+                stream_id, _, circ_id = fields
+                if record["time_to_first_stream"] is None:
+                    record["time_to_first_stream"] = t - self.visit_start
+                stream_ids.add(stream_id)
+                if circ_id and circ_id not in circuit_ids:
+                    circuit_ids.append(circ_id)
+        record["streams"] = len(stream_ids)
+        # circuits built before the visit are looked up from tor
+        record["circuits"] = [
+            {"id": circ_id,
+             "path": circuit_paths.get(circ_id) or
+             self.get_circuit_path(circ_id)}
+            for circ_id in circuit_ids]
+        return record
+
+    def get_circuit_path(self, circ_id):
+        """Return the relay fingerprints of a circuit that is still open."""
+        if self.controller is None:
+            return []
+        try:
+            circuit = self.controller.get_circuit(circ_id)
+        except (ValueError, ControllerError):  # the circuit is closed
+            return []
+        return [fingerprint for fingerprint, _ in circuit.path]
@@ -0,0 +1,262 @@
+import json
+import errno
+import socket
+import selectors
+import threading
+from time import time, monotonic
+
+
+RECV_BUFFER_SIZE = 65536
+# stop reading from a socket while this much data waits for its peer
+MAX_PENDING_BYTES = 1024 * 1024
+UPSTREAM_CONNECT_TIMEOUT = 5
+# seconds between the checks for upstream connects that timed out
+SELECT_TIMEOUT = 1
+
+
+class RelayedConnection(object):
+    """A browser connection and its connection to the upstream SOCKS port."""
+    def __init__(self, conn_id, client, upstream):
+        self.conn_id = conn_id
+        self.client = client
+        self.upstream = upstream
+        self.peer = {client: upstream, upstream: client}
+        self.pending = {client: bytearray(), upstream: bytearray()}
+        self.registered = set()
+        # the upstream connect is in progress until this deadline
+        self.connecting = False
+        self.connect_deadline = None
+        self.closing = False
+        self.closed = False
+
+    def direction(self, sock):
+        """Direction of the data read from sock."""
+        return "out" if sock is self.client else "in"
+
+
+class SocksRecorder(object):
+    """Local relay between Tor Browser and tor's SOCKS port that records
+    the timestamp, direction and size of the data on each connection.
+
+    The relay does not parse SOCKS: it passes the bytes through as they
+    are. All connections are served by a single thread, which never
+    blocks: upstream connections are made in the background, and an
+    error on one connection only closes that connection. Records are
+    written as JSON lines to the trace file set by start_trace(), and are
+    not kept in memory:
+
+        {"t": 1700000000.123456, "conn": 1, "event": "open"}
+        {"t": 1700000000.234567, "conn": 1, "dir": "out", "len": 517}
+    """
+    def __init__(self, upstream_port, upstream_host="127.0.0.1"):
+        self.upstream_port = upstream_port
+        self.upstream_host = upstream_host
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # maps sockets to their RelayedConnection
+        self.is_running = False
+        self._next_conn_id = 1
+        self._trace_file = None
+        self._trace_lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._thread = None
+
+    def start(self):
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self.is_running = True
+        self._thread = threading.Thread(target=self.serve, daemon=True,
+                                        name="tbselenium-socks-recorder")
+        self._thread.start()
+
+    def stop(self):
+        """Stop relaying, close all connections and the trace file."""
+        if not self.is_running:
+            return
+        self.is_running = False
+        self._wakeup_w.send(b"\0")
+        self._thread.join()
+        for conn in set(self.connections.values()):
+            self.close_connection(conn)
+        self.selector.close()
+        self.listener.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        self.stop_trace()
+
+    def start_trace(self, trace_path):
+        """Write the records to the given file, until stop_trace()."""
+        trace_file = open(trace_path, "w")
+        with self._trace_lock:
+            previous, self._trace_file = self._trace_file, trace_file
+        if previous:
+            previous.close()
+
+    def stop_trace(self):
+        with self._trace_lock:
+            trace_file, self._trace_file = self._trace_file, None
+        if trace_file:
+            trace_file.close()
+
+    def record(self, conn, **fields):
+        with self._trace_lock:
+            if self._trace_file is None:
+                return
+            record = {"t": round(time(), 6), "conn": conn.conn_id}
+            record.update(fields)
+            self._trace_file.write(json.dumps(record) + "\n")
+
+    def serve(self):
+        while self.is_running:
+            for key, events in self.selector.select(SELECT_TIMEOUT):
+                sock = key.fileobj
+                if sock is self._wakeup_r:
+                    return
+                conn = None
+                try:
+                    if sock is self.listener:
+                        self.accept()
+                        continue
+                    conn = self.connections.get(sock)
+                    if conn is None or conn.closed:
+                        continue
+                    if conn.connecting:
+                        self.finish_connect(conn)
+                    else:
+                        if events & selectors.EVENT_WRITE:
+                            self.flush(conn, sock)
+                        if events & selectors.EVENT_READ:
+                            self.relay(conn, sock)
+                    self.update_events(conn)
+                except Exception as e:
+                    print("[tbselenium] SOCKS recorder error: %s" % e)
+                    if conn is not None:
+                        self.abort_connection(conn)
+            self.expire_connects()
+
+    def accept(self):
+        try:
+            client, _ = self.listener.accept()
+        except OSError:
+            return
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        upstream.setblocking(False)
+        client.setblocking(False)
+        err = upstream.connect_ex((self.upstream_host, self.upstream_port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            client.close()
+            upstream.close()
+            return
+        conn = RelayedConnection(self._next_conn_id, client, upstream)
+        self._next_conn_id += 1
+        for sock in (client, upstream):
+            self.connections[sock] = conn
+        if err:
+            conn.connecting = True
+            conn.connect_deadline = monotonic() + UPSTREAM_CONNECT_TIMEOUT
+        else:
+            self.record(conn, event="open")
+        self.update_events(conn)
+
+    def finish_connect(self, conn):
+        """Check the result of the upstream connect, once it's writable."""
+        err = conn.upstream.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            return self.close_connection(conn)
+        conn.connecting = False
+        self.record(conn, event="open")
+
+    def expire_connects(self):
+        """Close the connections whose upstream connect timed out."""
+        now = monotonic()
+        for conn in set(self.connections.values()):
+            if conn.connecting and now > conn.connect_deadline:
+                self.close_connection(conn)
+
+    def abort_connection(self, conn):
+        """Close a connection after an unexpected error."""
+        try:
+            self.close_connection(conn)
+        except Exception as e:
+            print("[tbselenium] Cannot close the connection: %s" % e)
+
+    def relay(self, conn, sock):
+        """Read from sock and queue the data for its peer."""
+        try:
+            data = sock.recv(RECV_BUFFER_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            # send what's left to the peer, then close both sides
+            conn.closing = True
+            return
+        self.record(conn, dir=conn.direction(sock), len=len(data))
+        peer = conn.peer[sock]
+        conn.pending[peer] += data
+        self.flush(conn, peer)
+
+    def flush(self, conn, sock):
+        """Send as much of the data pending for sock as we can."""
+        pending = conn.pending[sock]
+        if not pending:
+            return
+        try:
+            sent = sock.send(pending)
+        except BlockingIOError:
+            return
+        except OSError:
+            pending.clear()
+            conn.closing = True
+            return
+        del pending[:sent]
+
+    def update_events(self, conn):
+        """Watch each socket for the events we can handle now."""
+        if conn.closing and not any(conn.pending.values()):
+            return self.close_connection(conn)
+        for sock in (conn.client, conn.upstream):
+            events = 0
+            if conn.connecting:
+                # wait for the connect before relaying any data
+                if sock is conn.upstream:
+                    events = selectors.EVENT_WRITE
+                self.set_events(conn, sock, events)
+                continue
+            # stop reading while the peer has too much data to send
+            if not conn.closing and \
+                    len(conn.pending[conn.peer[sock]]) < MAX_PENDING_BYTES:
+                events |= selectors.EVENT_READ
+            if conn.pending[sock]:
+                events |= selectors.EVENT_WRITE
+            self.set_events(conn, sock, events)
+
+    def set_events(self, conn, sock, events):
+        if sock in conn.registered:
+            if events:
+                self.selector.modify(sock, events)
+            else:
+                self.selector.unregister(sock)
+                conn.registered.discard(sock)
+        elif events:
+            self.selector.register(sock, events)
+            conn.registered.add(sock)
+
+    def close_connection(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        for sock in (conn.client, conn.upstream):
+            if sock in conn.registered:
+                self.selector.unregister(sock)
+            self.connections.pop(sock, None)
+            sock.close()
+        conn.registered.clear()
+        if not conn.connecting:  # the connection was opened
+            self.record(conn, event="close")
+
@@ -1,10 +1,13 @@
+import os
+import stat
+import signal
+import shutil
 import tempfile
 import tbselenium.common as cm
-import json
 from os import environ
-from os.path import dirname, isfile, join
-from time import sleep
-from tbselenium.exceptions import StemLaunchError
+from os.path import dirname, isfile, join, getmtime
+from time import time
+from tbselenium.exceptions import StemLaunchError, TBDriverPathError
 from selenium.webdriver.common.utils import is_connectable
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.wait import WebDriverWait
@@ -19,9 +22,16 @@ except ImportError:
 
 try:  # only needed for tests and examples
     from stem.process import launch_tor_with_config
+    from stem.control import Controller
+    from stem import Signal
 except ImportError:
     pass
 
+try:  # only needed for killing browser process trees
+    import psutil
+except ImportError:
+    psutil = None
+
 # Default dimensions for the virtual display
 DEFAULT_XVFB_WIN_W = 1280
 DEFAULT_XVFB_WIN_H = 800
@@ -37,6 +47,88 @@ TB_SECURITY_LEVELS = [
     TB_SECURITY_LEVEL_SAFEST
 ]
 
+# Tor Browser applies the security level whenever this pref changes
+TB_SECURITY_SLIDER_PREF = 'browser.security_level.security_slider'
+TB_SECURITY_SLIDER_VALUES = {
+    TB_SECURITY_LEVEL_STANDARD: 4,
+    TB_SECURITY_LEVEL_SAFER: 2,
+    TB_SECURITY_LEVEL_SAFEST: 1
+}
+# Tor Browser clears this pref when it applies a level, and sets it when
+# the user changes one of the level's prefs
+TB_SECURITY_CUSTOM_PREF = 'browser.security_level.security_custom'
+# Tor Browser turns off the IonMonkey JIT at the safer and safest levels
+TB_SECURITY_ION_PREF = 'javascript.options.ion'
+
+
+GET_PREF_SCRIPT = """
+const name = arguments[0];
+switch (Services.prefs.getPrefType(name)) {
+  case Services.prefs.PREF_BOOL: return Services.prefs.getBoolPref(name);
+  case Services.prefs.PREF_INT: return Services.prefs.getIntPref(name);
+  case Services.prefs.PREF_STRING: return Services.prefs.getStringPref(name);
+  default: return null;
+}
+"""
+
+# Set all the prefs or none: if a setter throws, e.g. for a value of the
+# wrong type, the prefs that were already set are restored.
+SET_PREFS_SCRIPT = """
+const prefs = arguments[0];
+const previous = {};
+const hadUserValue = {};
+function setPref(name, value) {
+  if (value === null) {
+    Services.prefs.clearUserPref(name);
+  } else if (typeof value === "boolean") {
+    Services.prefs.setBoolPref(name, value);
+  } else if (typeof value === "number") {
+    Services.prefs.setIntPref(name, value);
+  } else {
+    Services.prefs.setStringPref(name, value);
+  }
+}
+try {
+  for (const [name, value] of Object.entries(prefs)) {
+    switch (Services.prefs.getPrefType(name)) {
+      case Services.prefs.PREF_BOOL:
+        previous[name] = Services.prefs.getBoolPref(name); break;
+      case Services.prefs.PREF_INT:
+        previous[name] = Services.prefs.getIntPref(name); break;
+      case Services.prefs.PREF_STRING:
+        previous[name] = Services.prefs.getStringPref(name); break;
+      default:
+        previous[name] = null;
+    }
+    hadUserValue[name] = Services.prefs.prefHasUserValue(name);
+    setPref(name, value);
+  }
+} catch (e) {
+  for (const [name, value] of Object.entries(previous)) {
+    if (hadUserValue[name]) {
+      setPref(name, value);
+    } else {
+      Services.prefs.clearUserPref(name);
+    }
+  }
+  throw e;
+}
+return previous;
+"""
+
+BROWSER_READY_SCRIPT = """
+const win = Services.wm.getMostRecentWindow("navigator:browser");
+if (!win || !win.gBrowserInit || !win.gBrowserInit.delayedStartupFinished)
+  return false;
+if (!win.document.getElementById("security-level-button"))
+  return false;
+if (arguments[0]) {
+  const policy = WebExtensionPolicy.getByID(arguments[0]);
+  return Boolean(policy && policy.active);
+}
+return true;
+"""
+
 
 def start_xvfb(win_width=DEFAULT_XVFB_WIN_W,
                win_height=DEFAULT_XVFB_WIN_H):
@@ -57,13 +149,77 @@ def is_busy(port_no):
     return is_connectable(port_no)
 
 
-def prepend_to_env_var(env_var, new_value):
-    """Add the given value to the beginning of the environment var."""
-    if environ.get(env_var, None):
-        if new_value not in environ[env_var].split(':'):
-            environ[env_var] = "%s:%s" % (new_value, environ[env_var])
+def prepend_to_env_var(env_var, new_value, env=environ):
+    """Add the given value to the beginning of the environment var.
+
+    Modify the environment of this process, unless another `env`
+    mapping is given.
+    """
+    if env.get(env_var, None):
+        if new_value not in env[env_var].split(':'):
+            env[env_var] = "%s:%s" % (new_value, env[env_var])
     else:
-        environ[env_var] = new_value
+        env[env_var] = new_value
+
+
+def kill_process_tree(pid, timeout=5):
+    """Kill the process with the given pid and all of its descendants.
+
+    Without psutil, only the process itself is killed.
+    """
+    if psutil is None:
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        return
+    try:
+        parent = psutil.Process(pid)
+        processes = parent.children(recursive=True) + [parent]
+    except psutil.NoSuchProcess:
+        return
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(processes, timeout=timeout)
+
+
+def get_process_tree_usage(pid):
+    """Return the memory and CPU usage of the process and its descendants,
+    or None if the process is gone. Requires psutil.
+
+    rss is the sum of the resident set sizes in bytes, which counts the
+    memory shared between the processes more than once. cpu_time is the
+    user and system CPU time in seconds.
+    """
+    if psutil is None:
+        raise ImportError("Install psutil to sample the resource usage")
+    try:
+        parent = psutil.Process(pid)
+        processes = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return None
+    usage = {"n_processes": 0, "rss": 0, "cpu_time": 0.0}
+    for process in processes:
+        try:
+            with process.oneshot():
+                memory_info = process.memory_info()
+                cpu_times = process.cpu_times()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        usage["n_processes"] += 1
+        usage["rss"] += memory_info.rss
+        usage["cpu_time"] += cpu_times.user + cpu_times.system
+    return usage
+
+
+def send_newnym(control_port, password=None):
+    """Ask tor to use new circuits for new connections. Requires Stem."""
+    with Controller.from_port(port=control_port) as controller:
+        controller.authenticate(password=password)
+        controller.signal(Signal.NEWNYM)
 
 
 def read_file(file_path, mode='r'):
@@ -73,8 +229,87 @@ def read_file(file_path, mode='r'):
     return content
 
 
-def launch_tbb_tor_with_stem(tbb_path=None, torrc=None, tor_binary=None):
-    """Launch the Tor binary in tbb_path using Stem."""
+def is_private_stat(st):
+    """Return True if the file is owned by the current user, and other
+    users can't write to it."""
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def make_private_dir(dir_path):
+    """Create dir_path with mode 0o700 if it doesn't exist, and return it.
+
+    Raise TBDriverPathError if dir_path is not a directory of the current
+    user that others can't write to, e.g. if it was planted in a shared
+    temp dir. Subdirs of cm.TBSELENIUM_TMP_DIR check that directory too.
+    """
+    parent = dirname(dir_path.rstrip(os.sep))
+    if parent == cm.TBSELENIUM_TMP_DIR:
+        make_private_dir(parent)
+    elif parent:
+        os.makedirs(parent, exist_ok=True)
+    try:
+        os.mkdir(dir_path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(dir_path)
+    if not stat.S_ISDIR(st.st_mode) or not is_private_stat(st):
+        raise TBDriverPathError("%s should be a directory of the current "
+                                "user that others can't write to"
+                                % dir_path)
+    return dir_path
+
+
+def copy_file_atomically(src, dst):
+    """Copy src to dst so that dst never appears partially written."""
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(dst))
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def is_tor_data_seed_stale(seed_dir, max_age=cm.TOR_DATA_SEED_MAX_AGE):
+    """Return True if the seed has no consensus or it's older than max_age."""
+    consensus_path = join(seed_dir, cm.TOR_CONSENSUS_FILE)
+    if not isfile(consensus_path):
+        return True
+    return time() - getmtime(consensus_path) > max_age
+
+
+def seed_tor_data_dir(data_dir, seed_dir):
+    """Copy the cached directory documents in seed_dir to data_dir.
+
+    tor loads the consensus, microdescriptors and certificates from
+    its DataDirectory on startup, instead of downloading them all.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    for file_name in cm.TOR_DATA_SEED_FILES:
+        seed_file = join(seed_dir, file_name)
+        if isfile(seed_file):
+            shutil.copy2(seed_file, join(data_dir, file_name))
+
+
+def update_tor_data_seed(seed_dir, data_dir):
+    """Copy the cached directory documents of a bootstrapped tor to
+    seed_dir, for the tor processes we launch next."""
+    make_private_dir(seed_dir)
+    for file_name in cm.TOR_DATA_SEED_FILES:
+        data_file = join(data_dir, file_name)
+        if isfile(data_file):
+            copy_file_atomically(data_file, join(seed_dir, file_name))
+
+
+def launch_tbb_tor_with_stem(tbb_path=None, torrc=None, tor_binary=None,
+                             data_dir_seed=None):
+    """Launch the Tor binary in tbb_path using Stem.
+
+    If data_dir_seed is given, the DataDirectory is seeded with the
+    consensus and descriptors cached in this directory, which cuts the
+    bootstrap time. The seed is refreshed once it gets stale.
+    """
     if not (tor_binary or tbb_path):
         raise StemLaunchError("Either pass tbb_path or tor_binary")
 
@@ -90,33 +325,70 @@ def launch_tbb_tor_with_stem(tbb_path=None, torrc=None, tor_binary=None):
                  'SOCKSPort': str(cm.STEM_SOCKS_PORT),
                  'DataDirectory': tempfile.mkdtemp()}
 
-    return launch_tor_with_config(config=torrc, tor_cmd=tor_binary)
+    data_dir = torrc.get('DataDirectory')
+    if data_dir_seed and data_dir:
+        seed_tor_data_dir(data_dir, data_dir_seed)
+
+    tor_process = launch_tor_with_config(config=torrc, tor_cmd=tor_binary)
+    if data_dir_seed and data_dir and is_tor_data_seed_stale(data_dir_seed):
+        # tor is running, don't lose it over a seed we can't refresh
+        try:
+            update_tor_data_seed(data_dir_seed, data_dir)
+        except (OSError, TBDriverPathError) as e:
+            print("[tbselenium] Cannot refresh the tor data seed: %s" % e)
+    return tor_process
 
 
 def set_tbb_pref(driver, name, value):
+    set_tbb_prefs(driver, {name: value})
+
+
+def set_tbb_prefs(driver, prefs):
+    """Set the given prefs in a single chrome script.
+
+    Values can be bool, int or str. None resets the pref to its default.
+    Return the previous values, which can be passed to this function
+    to roll the changes back. Prefs that were not set map to None. If a
+    pref can't be set, none of the prefs are changed.
+    """
     try:
-        script = 'Services.prefs.'
-        if isinstance(value, bool):
-            script += 'setBoolPref'
-        elif isinstance(value, (str)):
-            script += 'setStringPref'
-        else:
-            script += 'setIntPref'
-        script += '({0}, {1});'.format(json.dumps(name), json.dumps(value))
-
-        with driver.context(driver.CONTEXT_CHROME):
-            driver.execute_script(script)
-    except Exception:
-        raise
+        driver.set_context(driver.CONTEXT_CHROME)
+        return driver.execute_script(SET_PREFS_SCRIPT, prefs)
     finally:
         driver.set_context(driver.CONTEXT_CONTENT)
 
 
-def set_security_level(driver, level):
+def set_security_level(driver, level, use_ui=False):
+    """Set the security level, unless the driver is known to be at it.
+
+    By default, we set the security slider pref in a single chrome script
+    and wait until Tor Browser applies the level, see
+    wait_for_security_level. Pass use_ui=True to click through the
+    security level panel on about:preferences instead, which takes
+    seconds.
+    """
     if level not in TB_SECURITY_LEVELS:
         raise ValueError(f"Invalid Tor Browser security setting: {level}")
-    open_security_level_panel(driver)
-    click_to_set_security_level(driver, level)
+    if getattr(driver, "security_level", None) == level:
+        return
+    if use_ui:
+        open_security_level_panel(driver)
+        click_to_set_security_level(driver, level)
+    else:
+        slider_value = TB_SECURITY_SLIDER_VALUES[level]
+        set_tbb_prefs(driver, {TB_SECURITY_SLIDER_PREF: slider_value})
+        wait_for_security_level(driver, level)
+    driver.security_level = level
+
+
+def wait_for_security_level(driver, level, timeout=3):
+    """Wait until Tor Browser applies the level: it sets the prefs of the
+    level, such as the JIT pref, and clears the custom level flag."""
+    ion_enabled = level == TB_SECURITY_LEVEL_STANDARD
+    WebDriverWait(driver, timeout).until(
+        lambda drv: get_tbb_pref(drv, TB_SECURITY_ION_PREF) == ion_enabled
+        and not get_tbb_pref(drv, TB_SECURITY_CUSTOM_PREF),
+        f"Security level {level} is not applied after {timeout}s")
 
 
 def js_click_by_id(driver, element_id):
@@ -173,9 +445,41 @@ def click_to_set_security_level(driver, level):
                 By.CSS_SELECTOR, f'#securityLevel-vbox-{level} radio').click()
 
 
+def get_tbb_pref(driver, name):
+    """Return the value of the given pref, or None if it's not set."""
+    with driver.context(driver.CONTEXT_CHROME):
+        return driver.execute_script(GET_PREF_SCRIPT, name)
+
+
+def wait_for_tbb_pref(driver, name, value, timeout=3):
+    """Wait until the given pref reads back as the expected value."""
+    WebDriverWait(driver, timeout).until(
+        lambda drv: get_tbb_pref(drv, name) == value,
+        f"Pref {name} is not set to {value} after {timeout}s")
+
+
 def disable_js(driver):
+    # the pref is set synchronously in the parent process, and pref changes
+    # reach the content processes before subsequent loads
     set_tbb_pref(driver, "javascript.enabled", False)
-    sleep(1)  # wait for the pref to update
+
+
+def is_browser_ready(driver, addon_id=None):
+    """Return True if the browser window, Torbutton's security level
+    button and (optionally) the add-on with the given ID are initialized."""
+    with driver.context(driver.CONTEXT_CHROME):
+        return driver.execute_script(BROWSER_READY_SCRIPT, addon_id)
+
+
+def wait_for_browser_ready(driver, timeout=cm.BROWSER_READY_TIMEOUT,
+                           addon_id=cm.NO_SCRIPT_ADDON_ID):
+    """Wait until the browser is ready to be automated.
+
+    Raise TimeoutException if the browser is not ready within `timeout`.
+    """
+    WebDriverWait(driver, timeout, poll_frequency=0.1).until(
+        lambda drv: is_browser_ready(drv, addon_id),
+        f"Browser is not ready after {timeout}s")
 
 def get_js_status_text(driver):
     """Return the text of the JS status element."""
@@ -0,0 +1,39 @@
+import threading
+from tbselenium.exceptions import TimeExceededError
+
+
+class Watchdog(object):
+    """Kill the browser if the enclosed block doesn't finish in time.
+
+    A stuck browser may block WebDriver calls, including quit(), forever.
+    On expiry, the watchdog kills the geckodriver and browser processes
+    from another thread, which makes the blocked call fail, and raises
+    TimeExceededError when the block exits:
+
+        with Watchdog(driver, 60):
+            driver.load_url(url)
+    """
+    def __init__(self, driver, timeout):
+        self.driver = driver
+        self.timeout = timeout
+        self.expired = False
+        self._timer = None
+
+    def expire(self):
+        self.expired = True
+        self.driver.kill()
+
+    def __enter__(self):
+        self._timer = threading.Timer(self.timeout, self.expire)
+        self._timer.daemon = True
+        self._timer.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._timer.cancel()
+        # wait for the browser to be killed if the timer just fired
+        self._timer.join()
+        if self.expired:
+            raise TimeExceededError("Browser killed after %s seconds"
+                                    % self.timeout) from exc_value
+        return False